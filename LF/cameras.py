@@ -3,6 +3,119 @@ import bmesh
 import mathutils
 import math
 import os
+import json
+import shutil
+import numpy as np
+import sys
+
+# The render ledger and progress are shared with lfDispatch.py next to this file
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import lfDispatch
+
+def migrateLegacyRig(scene):
+    """ Creates the manifest of a camera array generated before the manifest existed, the cameras are the LF_Cam_<index> objects of the scene.
+        The cameras are linked to a new LF_Cam collection, returns it or None if there are no such cameras.
+    """
+    legacy = sorted(((int(obj.name[7:]), obj) for obj in scene.objects if obj.name[:7] == "LF_Cam_" and obj.name[7:].isdigit()), key=lambda camera: camera[0])
+    if not legacy:
+        return None
+    # A collection of its own, the cameras can be in the scene collection or share one with other objects
+    rig = bpy.data.collections.new("LF_Cam")
+    scene.collection.children.link(rig)
+    for index, obj in legacy:
+        rig.objects.link(obj)
+    cameras = [{"name": obj.name, "index": index, "grid": None} for index, obj in legacy]
+    manifest = {"version": 1, "type": None, "density": None, "size": None, "aspect": None,
+                "gridSize": None, "baseline": None, "prefix": "LF_Cam", "cameras": cameras}
+    updateManifest(scene, rig, manifest)
+    scene["lfRig"] = rig
+    return rig
+
+def getRig(scene):
+    """ Returns the collection of the last generated camera array and its manifest, None if there is no array.
+        The cameras of older files get their manifest here once.
+    """
+    rig = scene.get("lfRig")
+    if rig is None or "lfManifest" not in rig:
+        rig = migrateLegacyRig(scene)
+        if rig is None:
+            return None, None
+    return rig, json.loads(rig["lfManifest"])
+
+def getRigCameras(rig, manifest):
+    """ Returns the (camera object, index) pairs in the order of the manifest.
+    """
+    return [(rig.objects[camera["name"]], camera["index"]) for camera in manifest["cameras"]]
+
+def updateManifest(scene, rig, manifest):
+    """ Stores the current intrinsics and extrinsics of the cameras in the manifest.
+    """
+    bpy.context.view_layer.update()
+    renderInfo = scene.render
+    data = rig.objects[manifest["cameras"][0]["name"]].data
+    manifest["intrinsics"] = {"type": data.type, "lens": data.lens, "sensorWidth": data.sensor_width, "sensorHeight": data.sensor_height,
+                              "sensorFit": data.sensor_fit, "angleX": data.angle_x, "angleY": data.angle_y,
+                              "shift": [data.shift_x, data.shift_y], "clip": [data.clip_start, data.clip_end],
+                              "resolution": [int((renderInfo.resolution_x * renderInfo.resolution_percentage)/100),
+                                             int((renderInfo.resolution_y * renderInfo.resolution_percentage)/100)]}
+    for camera in manifest["cameras"]:
+        matrix = rig.objects[camera["name"]].matrix_world
+        camera["location"] = list(matrix.translation)
+        camera["rotation"] = list(matrix.to_euler())
+        camera["matrixWorld"] = [list(row) for row in matrix]
+    rig["lfManifest"] = json.dumps(manifest)
+
+def enableDepth(scene):
+    """ Adds the Z pass to the render and stores the color and depth of each view in one multilayer EXR.
+        Returns the original settings for restoreDepth.
+    """
+    imageSettings = scene.render.image_settings
+    original = {"passes": {viewLayer.name: viewLayer.use_pass_z for viewLayer in scene.view_layers},
+                "format": imageSettings.file_format, "colorDepth": imageSettings.color_depth}
+    for viewLayer in scene.view_layers:
+        viewLayer.use_pass_z = True
+    imageSettings.file_format = 'OPEN_EXR_MULTILAYER'
+    imageSettings.color_depth = '32'
+    return original
+
+def restoreDepth(scene, original):
+    imageSettings = scene.render.image_settings
+    imageSettings.file_format = original["format"]
+    imageSettings.color_depth = original["colorDepth"]
+    for viewLayer in scene.view_layers:
+        viewLayer.use_pass_z = original["passes"][viewLayer.name]
+
+def getSettingsHash(scene, manifest):
+    """ Hash of the settings affecting the rendered views, the manifest has to be updated first.
+    """
+    renderInfo = scene.render
+    imageSettings = renderInfo.image_settings
+    settings = {"engine": renderInfo.engine, "format": imageSettings.file_format, "colorDepth": imageSettings.color_depth,
+                "colorMode": imageSettings.color_mode, "intrinsics": manifest["intrinsics"],
+                "cameras": [camera["matrixWorld"] for camera in manifest["cameras"]]}
+    if renderInfo.engine == 'CYCLES':
+        settings["samples"] = scene.cycles.samples
+    return lfDispatch.hashSettings(settings)
+
+def getOutputFile(scene, path, index, frame):
+    return path+"/"+str(index)+"/"+str(scene.frame_start-frame)+scene.render.file_extension
+
+def writeRigFiles(scene, path):
+    """ Writes the info file and the manifest.json of the camera array to the output folder, returns the updated manifest.
+    """
+    rig, manifest = getRig(scene)
+    updateManifest(scene, rig, manifest)
+    with open(path+"/manifest.json", "w") as file:
+        json.dump(manifest, file, indent=1)
+    renderInfo = scene.render
+    infoFile = open(path+"/info", "w")
+    infoFile.write("Camera count: " + str(len(manifest["cameras"])))
+    infoFile.write("\nFPS: " + str(renderInfo.fps))
+    infoFile.write("\nFrame count: " + str(scene.frame_end - scene.frame_start))
+    infoFile.write("\nWidth: " + str(int((renderInfo.resolution_x * renderInfo.resolution_percentage)/100)))
+    infoFile.write("\nHeight: " + str(int((renderInfo.resolution_y * renderInfo.resolution_percentage)/100)))
+    infoFile.close()
+    return manifest
 
 class LFPanel(bpy.types.Panel):
     bl_space_type = "VIEW_3D"
@@ -18,7 +131,10 @@ class LFPanel(bpy.types.Panel):
         col.prop(context.scene, "lfType")
         col.prop(context.scene, "lfSize")
         col.prop(context.scene, "lfDensity")
+        col.prop(context.scene, "lfMaxCameras")
         col.prop(context.scene, "lfDepth")
+        col.prop(context.scene, "lfRenderOrder")
+        col.prop(context.scene, "lfResume")
         col.operator("mesh.generate", text="Generate")
         col.operator("mesh.render", text="Render")
 
@@ -29,88 +145,253 @@ class LFArray(bpy.types.Operator):
     bl_label = "Generate LF array"
     bl_options = {"UNDO"}
 
-    def invoke(self, context, event):
+    def estimateCount(self, scene):
+        if scene.lfType == "row":
+            return scene.lfDensity
+        if scene.lfType == "plane":
+            return (scene.lfDensity+1)**2
+        return 10*4**(scene.lfDensity-1)+2
+
+    def getTransforms(self, scene):
+        """ Returns the locations and rotations of the cameras as Nx3 arrays.
+        """
+        if scene.lfType == "row":
+            baseline = scene.lfSize/scene.lfDensity
+            locations = np.zeros((scene.lfDensity, 3), dtype=np.float32)
+            locations[:, 1] = (scene.lfDensity/2.0 - np.arange(scene.lfDensity))*baseline
+            rotations = np.tile(np.array([1.57, 0, 1.57], dtype=np.float32), (scene.lfDensity, 1))
+            return locations, rotations
+
         bm = bmesh.new()
-        mesh = bpy.data.meshes.new('Basic_Cube')
-        lookAtCenter = False
-  
-        if context.scene.lfType == "row":
-            position = [0,0,0]
-            baseline = context.scene.lfSize/context.scene.lfDensity
-            for i in range(context.scene.lfDensity):
-                position = [0,0,0]
-                position[1] = (context.scene.lfDensity/2.0 - i)*baseline
-                bpy.ops.object.camera_add(location=position, rotation=(1.57,0,1.57))  
-                camera = context.object
-                camera.name = "LF_Cam_"+str(i)
-        
+        if scene.lfType == "plane":
+            ratio = 1.0
+            if scene.lfAspect == "16:9":
+                ratio = 16.0/9
+            elif scene.lfAspect == "4:3":
+                ratio = 4.0/3.0
+            mat = mathutils.Matrix.Scale(ratio, 4, (1.0, 0.0, 0.0)) @ mathutils.Matrix.Rotation(math.radians(180), 4, 'X') #rotation to place the first cam to top left corner
+            bmesh.ops.create_grid(bm, x_segments=scene.lfDensity, y_segments=scene.lfDensity, size=scene.lfSize, matrix=mat)
         else:
-            if context.scene.lfType == "plane":   
-                ratio = 1.0
-                if context.scene.lfAspect == "16:9":
-                    ratio = 16.0/9
-                elif context.scene.lfAspect == "4:3":
-                    ratio = 4.0/3.0
-                mat = mathutils.Matrix.Scale(ratio, 4, (1.0, 0.0, 0.0)) @ mathutils.Matrix.Rotation(math.radians(180), 4, 'X') #rotation to place the first cam to top left corner
-                bmesh.ops.create_grid(bm, x_segments= context.scene.lfDensity, y_segments=context.scene.lfDensity, size=context.scene.lfSize, matrix=mat),
-            elif context.scene.lfType == "sphere":
-                bmesh.ops.create_icosphere(bm, subdivisions=context.scene.lfDensity, radius=context.scene.lfSize)
-                lookAtCenter = True
-            
-            bm.to_mesh(mesh)
-            for v in mesh.vertices:
-                direction = -v.co
-                rotation = (0,0,0)
-                if lookAtCenter:
-                    rotation = direction.to_track_quat('-Z', 'Y').to_euler()
-                bpy.ops.object.camera_add(location=v.co, rotation=rotation)  
-                camera = context.object
-                camera.name = "LF_Cam_"+str(v.index)       
-            
-        objects = bpy.context.scene.objects
-        for obj in objects:
-            obj.select_set(obj.name[:6] == "LF_Cam")
+            bmesh.ops.create_icosphere(bm, subdivisions=scene.lfDensity, radius=scene.lfSize)
+        mesh = bpy.data.meshes.new("LF_Grid")
+        bm.to_mesh(mesh)
+        bm.free()
+        locations = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+        mesh.vertices.foreach_get("co", locations)
+        bpy.data.meshes.remove(mesh)
+        locations = locations.reshape(-1, 3)
+        rotations = np.zeros_like(locations)
+        if scene.lfType == "sphere":
+            # The cameras look at the center
+            for i, location in enumerate(locations):
+                rotations[i] = (-mathutils.Vector(location)).to_track_quat('-Z', 'Y').to_euler()
+        return locations, rotations
+
+    def invoke(self, context, event):
+        scene = context.scene
+        count = self.estimateCount(scene)
+        if count > scene.lfMaxCameras:
+            self.report({"ERROR"}, "The array would have "+str(count)+" cameras, lower the density or raise the camera limit ("+str(scene.lfMaxCameras)+")")
+            return {"CANCELLED"}
+        locations, rotations = self.getTransforms(scene)
+
+        # All cameras share one camera data and are placed in their own collection, the collection name is the prefix of the camera names
+        collection = bpy.data.collections.new("LF_Rig")
+        cameraData = bpy.data.cameras.new(collection.name)
+        scene.collection.children.link(collection)
+        for i in range(len(locations)):
+            collection.objects.link(bpy.data.objects.new(collection.name+"_"+str(i), cameraData))
+        collection.objects.foreach_set("location", locations.ravel())
+        collection.objects.foreach_set("rotation_euler", rotations.ravel())
+        self.createManifest(scene, collection, locations)
+        scene["lfRig"] = collection
+
+        for obj in context.selected_objects:
+            obj.select_set(False)
+        for obj in collection.objects:
+            obj.select_set(True)
             
         return {"FINISHED"}
 
+    def createManifest(self, scene, rig, locations):
+        """ Stores the layout of the array in the rig collection as JSON, the camera transforms are added by updateManifest.
+        """
+        count = len(locations)
+        if scene.lfType == "row":
+            gridSize = [1, count]
+        elif scene.lfType == "plane":
+            cols = int(round(math.sqrt(count)))
+            gridSize = [count // cols, cols]
+        else:
+            gridSize = None
+        # The spacing of the columns and rows, they differ for the planes with other than 1:1 aspect
+        baseline = None
+        if gridSize is not None and count > 1:
+            baseline = [float(np.linalg.norm(locations[1]-locations[0])), None]
+            if gridSize[0] > 1:
+                baseline[1] = float(np.linalg.norm(locations[gridSize[1]]-locations[0]))
+        cameras = []
+        for i, obj in enumerate(rig.objects):
+            grid = [i // gridSize[1], i % gridSize[1]] if gridSize is not None else None
+            cameras.append({"name": obj.name, "index": i, "grid": grid})
+        manifest = {"version": 1, "type": scene.lfType, "density": scene.lfDensity, "size": scene.lfSize, "aspect": scene.lfAspect,
+                    "gridSize": gridSize, "baseline": baseline, "prefix": rig.name, "cameras": cameras}
+        updateManifest(scene, rig, manifest)
+
 class LFRender(bpy.types.Operator):
     """ Renders whole animation (start-end frame), all frames for one cam in one folder.
-        Takes format settings from Render options.
+        Takes format settings from Render options, with depth maps the views are stored as multilayer EXR instead.
     """
     bl_idname = "mesh.render"
     bl_label = "Render LF"
     bl_descripiton = "Render all views to the output folder"
-    #TODO render depthmaps button
+
+    # Number of cameras rendered as custom views of one multiview render, limits the memory of the render result
+    VIEWS_PER_RENDER = 16
+
+    def finishView(self, scene, path, index, frame):
+        self.ledger.record(index, frame, getOutputFile(scene, path, index, frame))
+        self.progress.step()
+        print(self.progress.getStatus())
+
+    def renderCameraMajor(self, scene, cameras, path):
+        renderInfo = scene.render
+        for obj, index in cameras:
+            scene.camera = obj
+            camPath = path+"/"+str(index)
+            if not os.path.exists(camPath):
+                os.makedirs(camPath)
+            #context.window_manager.progress_begin(0,context.scene.lfS)
+            for i in range(scene.frame_start, scene.frame_end+1):
+                if self.ledger.isDone(index, i, getOutputFile(scene, path, index, i)):
+                    continue
+                renderInfo.filepath = camPath+"/"+str(scene.frame_start-i)
+                scene.frame_set(i)
+                bpy.ops.render.render( write_still=True ) 
+                self.finishView(scene, path, index, i)
+
+    def enableMultiview(self, scene, cameras):
+        """ Adds a custom view for each camera, the view suffix selects the camera by its name (manifest prefix + _i).
+            Returns the original settings for restoreMultiview.
+        """
+        renderInfo = scene.render
+        original = {"use_multiview": renderInfo.use_multiview, "views_format": renderInfo.views_format,
+                    "image_views_format": renderInfo.image_settings.views_format,
+                    "views": {view.name: view.use for view in renderInfo.views}}
+        renderInfo.use_multiview = True
+        renderInfo.views_format = 'MULTIVIEW'
+        renderInfo.image_settings.views_format = 'INDIVIDUAL'
+        for view in renderInfo.views:
+            view.use = False
+        for obj, index in cameras:
+            view = renderInfo.views.new(obj.name)
+            view.camera_suffix = "_"+str(index)
+        return original
+
+    def restoreMultiview(self, scene, original):
+        renderInfo = scene.render
+        for view in list(renderInfo.views):
+            if view.name not in original["views"]:
+                renderInfo.views.remove(view)
+            else:
+                view.use = original["views"][view.name]
+        renderInfo.use_multiview = original["use_multiview"]
+        renderInfo.views_format = original["views_format"]
+        renderInfo.image_settings.views_format = original["image_views_format"]
+
+    def renderViews(self, scene, cameras, path, frame):
+        """ Renders the cameras in one multiview render and moves the view images to the camera folders.
+        """
+        renderInfo = scene.render
+        names = set(obj.name for obj, index in cameras)
+        for view in renderInfo.views:
+            view.use = view.name in names
+        scene.camera = cameras[0][0]
+        tempPath = path+"/.views"
+        name = str(scene.frame_start-frame)
+        renderInfo.filepath = tempPath+"/"+name
+        bpy.ops.render.render( write_still=True )
+        for obj, index in cameras:
+            viewFile = tempPath+"/"+name+"_"+str(index)+renderInfo.file_extension
+            os.replace(viewFile, path+"/"+str(index)+"/"+name+renderInfo.file_extension)
+            self.finishView(scene, path, index, frame)
+
+    def renderFrameMajor(self, scene, cameras, path, multiview):
+        """ Sets each frame once and renders all cameras in it, with multiview several cameras are rendered by one render call.
+            Every render evaluates the scene again, the persistent data keep the render data of the frame between the cameras instead.
+        """
+        renderInfo = scene.render
+        originalPersistent = renderInfo.use_persistent_data
+        renderInfo.use_persistent_data = True
+        for obj, index in cameras:
+            camPath = path+"/"+str(index)
+            if not os.path.exists(camPath):
+                os.makedirs(camPath)
+        original = self.enableMultiview(scene, cameras) if multiview else None
+        try:
+            for i in range(scene.frame_start, scene.frame_end+1):
+                pending = [(obj, index) for obj, index in cameras if not self.ledger.isDone(index, i, getOutputFile(scene, path, index, i))]
+                if not pending:
+                    continue
+                scene.frame_set(i)
+                name = str(scene.frame_start-i)
+                if multiview:
+                    for b in range(0, len(pending), self.VIEWS_PER_RENDER):
+                        self.renderViews(scene, pending[b:b+self.VIEWS_PER_RENDER], path, i)
+                else:
+                    for obj, index in pending:
+                        scene.camera = obj
+                        renderInfo.filepath = path+"/"+str(index)+"/"+name
+                        bpy.ops.render.render( write_still=True )
+                        self.finishView(scene, path, index, i)
+        finally:
+            renderInfo.use_persistent_data = originalPersistent
+            if original is not None:
+                self.restoreMultiview(scene, original)
+                if os.path.exists(path+"/.views"):
+                    shutil.rmtree(path+"/.views")
 
     def invoke(self, context, event):
-        renderInfo = bpy.data.scenes["Scene"].render
-        path = renderInfo.filepath[:]
-        camCount = 0
-        for obj in bpy.context.scene.objects:
-            if obj.name[:6] == "LF_Cam":
-                camCount += 1
-                bpy.context.scene.camera = obj
-                camPath = path+"/"+obj.name[7:]
-                if not os.path.exists(camPath):
-                    os.makedirs(camPath)
-                #context.window_manager.progress_begin(0,context.scene.lfS)
-                for i in range(bpy.context.scene.frame_start, bpy.context.scene.frame_end+1):
-                    renderInfo.filepath = camPath+"/"+str(bpy.context.scene.frame_start-i)
-                    bpy.context.scene.frame_set(i)
-                    bpy.ops.render.render( write_still=True ) 
-            
-        bpy.data.scenes["Scene"].render.filepath = path
-
-        infoFile = open(path+"/info", "w")
-        infoFile.write("Camera count: " + str(camCount))
-        infoFile.write("\nFPS: " + str(renderInfo.fps))
-        infoFile.write("\nFrame count: " + str(bpy.context.scene.frame_end - bpy.context.scene.frame_start))
-        infoFile.write("\nWidth: " + str(int((renderInfo.resolution_x * renderInfo.resolution_percentage)/100)))
-        infoFile.write("\nHeight: " + str(int((renderInfo.resolution_y * renderInfo.resolution_percentage)/100)))
-        #TODO camparams
-        infoFile.close()
-        
-        
+        scene = bpy.data.scenes["Scene"]
+        rig, manifest = getRig(scene)
+        if rig is None:
+            self.report({"ERROR"}, "Generate the LF array first")
+            return {"CANCELLED"}
+        cameras = getRigCameras(rig, manifest)
+        multiview = scene.lfRenderOrder == "multiview"
+        if multiview and scene.lfDepth:
+            # Multilayer EXR stores all views in one file
+            self.report({"WARNING"}, "Depth maps are rendered in the Frame order")
+            multiview = False
+        if multiview and any(obj.name != manifest["prefix"]+"_"+str(index) for obj, index in cameras):
+            self.report({"ERROR"}, "Multiview needs the cameras named by the rig ("+manifest["prefix"]+"_index)")
+            return {"CANCELLED"}
+        renderInfo = scene.render
+        originalPath = renderInfo.filepath[:]
+        path = bpy.path.abspath(originalPath)
+        originalCamera = scene.camera
+        originalFrame = scene.frame_current
+        originalDepth = enableDepth(scene) if scene.lfDepth else None
+        os.makedirs(path, exist_ok=True)
+        updateManifest(scene, rig, manifest)
+        self.ledger = lfDispatch.RenderLedger(path, getSettingsHash(scene, manifest), scene.lfResume)
+        frames = range(scene.frame_start, scene.frame_end+1)
+        remaining = sum(not self.ledger.isDone(index, i, getOutputFile(scene, path, index, i)) for obj, index in cameras for i in frames)
+        print(str(len(cameras)*len(frames)-remaining)+" views already rendered, "+str(remaining)+" remaining")
+        self.progress = lfDispatch.Progress(remaining)
+        try:
+            if scene.lfRenderOrder == "camera":
+                self.renderCameraMajor(scene, cameras, path)
+            else:
+                self.renderFrameMajor(scene, cameras, path, multiview)
+        finally:
+            scene.camera = originalCamera
+            scene.frame_set(originalFrame)
+            renderInfo.filepath = originalPath
+            if originalDepth is not None:
+                restoreDepth(scene, originalDepth)
+
+        writeRigFiles(scene, path)
         return {"FINISHED"}
 
 def register():
@@ -121,7 +402,10 @@ def register():
     bpy.types.Scene.lfAspect = bpy.props.EnumProperty(name="Aspect", description="Aspect ratio for the camera grid", items=[("16:9", "16:9", ""), ("4:3", "4:3", ""), ("1:1", "1:1", "")])
     bpy.types.Scene.lfSize = bpy.props.FloatProperty(name="Size", description="Scale of the array", default=1.0)
     bpy.types.Scene.lfDensity = bpy.props.IntProperty(name="Density", description="Density of the array", default=8)
-    bpy.types.Scene.lfDepth = bpy.props.BoolProperty(name="Depth maps", description="Will render depth maps too", default=True)
+    bpy.types.Scene.lfMaxCameras = bpy.props.IntProperty(name="Camera limit", description="Generating more cameras is refused, the sphere has 10*4^(density-1)+2 cameras", default=4096, min=1)
+    bpy.types.Scene.lfDepth = bpy.props.BoolProperty(name="Depth maps", description="Will render depth maps too, stored with the color in one multilayer EXR per view instead of the output format", default=False)
+    bpy.types.Scene.lfResume = bpy.props.BoolProperty(name="Resume", description="Skip the views recorded as finished in ledger.jsonl of the output folder", default=True)
+    bpy.types.Scene.lfRenderOrder = bpy.props.EnumProperty(name="Order", description="Order of the rendered views", items=[("camera","Camera","All frames of one camera after another"), ("frame","Frame","All cameras in one frame after another, the render data are kept between the cameras"), ("multiview","Multiview","Like Frame but the cameras are rendered as views of one multiview render")], default="frame")
     
 def unregister():
     bpy.utils.unregister_class(LFArray)
@@ -12,10 +12,16 @@ bl_info = {
 
 import bpy
 import os
+import sys
 import mathutils
 import math
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+# The image access shared by the LF scripts is in lfImages.py next to this file
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import lfImages
 
 class LFReader:
     cols = 0
@@ -45,10 +51,18 @@ class LFReader:
     def getImage(self, col, row):
         image = bpy.data.images.load(self.getImagePath(row,col), check_existing=True)
         return image
+
+    def getPixels(self, col, row):
+        return lfImages.cache.get(self.getImagePath(row,col))
+
+    def getRows(self, col, row, y0, y1):
+        return lfImages.cache.getRows(self.getImagePath(row,col), y0, y1)
+
+    def getTile(self, col, row, x0, y0, x1, y1):
+        return lfImages.cache.getTile(self.getImagePath(row,col), x0, y0, x1, y1)
     
     def getResolution(self):
-        image = bpy.data.images.load(self.getImagePath(0,0), check_existing=True)
-        return image.size
+        return lfImages.imageSize(self.getImagePath(0, 0))
 
 class LFPanel(bpy.types.Panel):
     bl_space_type = "VIEW_3D"
@@ -85,17 +99,25 @@ class LFGenerator(bpy.types.Operator):
         gridRes[0] *= colsRows[0]
         gridRes[1] *= colsRows[1]
         lfGrid = bpy.data.images.new("LFGrid", width=gridRes[0], height=gridRes[1])
-        lfGridPx = np.array([], dtype=float).reshape(resolution[1]*colsRows[1], 0)
-
-        for col in range(colsRows[0]):
-            pixelsCol = np.array([], dtype=float).reshape(0, resolution[0]*CHANNELS)
-            for row in range(colsRows[1]):                
-                image = lf.getImage(col, row)
-                pixels = np.asarray(image.pixels)
-                pixels = np.reshape(pixels, (-1, resolution[0]*CHANNELS))
-                pixelsCol = np.vstack([pixelsCol, pixels])
-            lfGridPx = np.hstack([lfGridPx, pixelsCol])
-        lfGrid.pixels = lfGridPx.flatten()  
+        lfGridPx = np.empty((gridRes[1], gridRes[0], CHANNELS), dtype=np.float32)
+        # OpenImageIO is used only when it decodes the views like Blender, checked on the first one
+        threaded = lfImages.decodeMatches(lf.getImagePath(0, 0))
+
+        def loadView(view):
+            col, row = view
+            path = lf.getImagePath(row, col)
+            pixels = lfImages.decodeImage(path) if threaded else lfImages.loadImage(path)
+            lfGridPx[row*resolution[1]:(row+1)*resolution[1], col*resolution[0]:(col+1)*resolution[0]] = pixels
+        views = [(col, row) for col in range(colsRows[0]) for row in range(colsRows[1])]
+        if threaded:
+            # The views are decoded and copied to their place in the grid in parallel
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool:
+                list(pool.map(loadView, views))
+        else:
+            # Blender data can be used only from the main thread
+            for view in views:
+                loadView(view)
+        lfGrid.pixels.foreach_set(lfGridPx.ravel())
     
     def createMaterial(self, context):
         self.createTexture(context)
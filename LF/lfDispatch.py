@@ -0,0 +1,270 @@
+""" Renders the LF camera array of a saved .blend file in parallel by several background Blender processes.
+    usage: python lfDispatch.py scene.blend [--workers 4] [--blender blender] [--threads 0] [--restart]
+    The jobs (one camera in one frame) are handed to the workers one by one as they finish so faster workers take more jobs.
+    The output is the same as from the Render LF button in cameras.py, the render settings are taken from the .blend file.
+    The same file is run inside Blender by the workers (blender -b scene.blend -P lfDispatch.py -- --worker).
+    Finished views are recorded in ledger.jsonl in the output folder and skipped when the render is started again, unless --restart is used.
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+# Prefix of the lines exchanged between the dispatcher and the workers, the rest of the Blender output is ignored
+MESSAGE = "LFDISPATCH "
+
+def formatDuration(seconds):
+    # The hours are not wrapped at a day, long renders and ETAs are common
+    seconds = int(seconds)
+    return "{}:{:02}:{:02}".format(seconds//3600, seconds//60 % 60, seconds % 60)
+
+def hashSettings(settings):
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+class RenderLedger:
+    """ Append-only record of the finished views in ledger.jsonl of the output folder, one JSON line per view with the file size and the hash of the render settings.
+        A view is finished when its entry has the current settings and the file still has the recorded size.
+        Without resume the previous ledger is deleted.
+    """
+    def __init__(self, path, settingsHash, resume=True):
+        self.file = os.path.join(path, "ledger.jsonl")
+        self.settingsHash = settingsHash
+        self.entries = {}
+        if not resume and os.path.exists(self.file):
+            os.remove(self.file)
+        if os.path.exists(self.file):
+            with open(self.file, "rb+") as file:
+                data = file.read()
+                # The line being written when the render was killed is cut off so that the next entry starts on its own line
+                if not data.endswith(b"\n"):
+                    data = data[:data.rfind(b"\n")+1]
+                    file.truncate(len(data))
+            for line in data.decode().splitlines():
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                self.entries[(entry["index"], entry["frame"])] = entry
+
+    def isDone(self, index, frame, outputFile):
+        entry = self.entries.get((index, frame))
+        if entry is None or entry["settings"] != self.settingsHash or entry["file"] != outputFile:
+            return False
+        return os.path.exists(outputFile) and os.path.getsize(outputFile) == entry["size"]
+
+    def record(self, index, frame, outputFile):
+        entry = {"index": index, "frame": frame, "file": outputFile, "size": os.path.getsize(outputFile),
+                 "settings": self.settingsHash, "time": time.time()}
+        self.entries[(index, frame)] = entry
+        with open(self.file, "a") as file:
+            file.write(json.dumps(entry)+"\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+class Progress:
+    """ Counts the finished jobs and estimates the remaining time from the average rate since the start.
+    """
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = time.perf_counter()
+
+    def step(self):
+        self.done += 1
+
+    def getElapsed(self):
+        return time.perf_counter()-self.start
+
+    def getStatus(self):
+        remaining = self.total-self.done
+        rate = self.done/max(self.getElapsed(), 1e-6)
+        eta = formatDuration(remaining/rate) if rate > 0 else "unknown"
+        return "{}/{} done, {} remaining, {:.2f} jobs/min, ETA {}".format(self.done, self.total, remaining, rate*60, eta)
+
+def report(message):
+    print(MESSAGE+json.dumps(message), flush=True)
+
+def listJobs():
+    """ Runs in Blender, reports all camera and frame pairs of the camera array and writes the info and manifest files.
+    """
+    # The camera array helpers are in cameras.py next to this file
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import cameras
+    # The scene properties of the panel are read with their defaults
+    cameras.register()
+    scene = bpy.context.scene
+    path = bpy.path.abspath(scene.render.filepath)
+    rig, manifest = cameras.getRig(scene)
+    if rig is None:
+        report({"type": "jobs", "jobs": [], "finished": 0})
+        return
+    os.makedirs(path, exist_ok=True)
+    # The same settings as in the workers so that the settings hash matches
+    if scene.lfDepth:
+        cameras.enableDepth(scene)
+    # The hash needs the current camera transforms
+    manifest = cameras.writeRigFiles(scene, path)
+    settingsHash = cameras.getSettingsHash(scene, manifest)
+    ledger = RenderLedger(path, settingsHash, "--restart" not in sys.argv)
+    jobs = []
+    finished = 0
+    for camera in manifest["cameras"]:
+        for frame in range(scene.frame_start, scene.frame_end+1):
+            if ledger.isDone(camera["index"], frame, cameras.getOutputFile(scene, path, camera["index"], frame)):
+                finished += 1
+            else:
+                jobs.append({"camera": camera["name"], "index": camera["index"], "frame": frame})
+    report({"type": "jobs", "jobs": jobs, "finished": finished, "path": path, "settings": settingsHash})
+
+def runWorker():
+    """ Runs in Blender, renders the jobs read from stdin until the quit message and reports each finished one.
+    """
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import cameras
+    cameras.register()
+    scene = bpy.context.scene
+    renderInfo = scene.render
+    path = bpy.path.abspath(renderInfo.filepath)
+    # The scene settings are not saved by the worker so they are not restored
+    if scene.lfDepth:
+        cameras.enableDepth(scene)
+    report({"type": "ready"})
+    for line in sys.stdin:
+        job = json.loads(line)
+        if job.get("type") == "quit":
+            break
+        scene.camera = bpy.data.objects[job["camera"]]
+        outputFile = cameras.getOutputFile(scene, path, job["index"], job["frame"])
+        os.makedirs(os.path.dirname(outputFile), exist_ok=True)
+        renderInfo.filepath = os.path.splitext(outputFile)[0]
+        scene.frame_set(job["frame"])
+        start = time.perf_counter()
+        bpy.ops.render.render(write_still=True)
+        report({"type": "done", "camera": job["camera"], "index": job["index"], "frame": job["frame"], "file": outputFile,
+                "seconds": time.perf_counter()-start})
+
+def blenderCommand(args, mode):
+    command = [args.blender, "-b", args.blend, "-P", os.path.abspath(__file__)]
+    if args.threads > 0:
+        command += ["-t", str(args.threads)]
+    command += ["--", mode]
+    if args.restart:
+        command += ["--restart"]
+    if args.cpu:
+        command += ["--cycles-device", "CPU"]
+    return command
+
+def readMessages(process, workerID, messages):
+    for line in process.stdout:
+        if line.startswith(MESSAGE):
+            messages.put((workerID, json.loads(line[len(MESSAGE):])))
+    messages.put((workerID, {"type": "exit"}))
+
+def getJobs(args):
+    process = subprocess.run(blenderCommand(args, "--list"), stdout=subprocess.PIPE, text=True)
+    for line in process.stdout.splitlines():
+        if line.startswith(MESSAGE):
+            message = json.loads(line[len(MESSAGE):])
+            if message["type"] == "jobs":
+                return message
+    raise RuntimeError("The jobs could not be listed, check that "+args.blend+" opens in "+args.blender)
+
+def sendMessage(process, message):
+    try:
+        process.stdin.write(json.dumps(message)+"\n")
+        process.stdin.flush()
+    except BrokenPipeError:
+        # The exit message of the worker follows and queues its job again
+        pass
+
+def dispatch(args, jobs, ledger):
+    """ Starts the workers and sends each of them a new job whenever it is ready, the jobs of crashed workers are sent again.
+        Workers without a job wait until all jobs are finished since a crash can still queue a job again. The finished jobs are recorded in the ledger.
+    """
+    pending = list(reversed(jobs))
+    messages = queue.Queue()
+    workers = []
+    running = {}
+    idle = []
+    for workerID in range(min(args.workers, len(jobs))):
+        process = subprocess.Popen(blenderCommand(args, "--worker"), stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        threading.Thread(target=readMessages, args=(process, workerID, messages), daemon=True).start()
+        workers.append(process)
+    alive = len(workers)
+    progress = Progress(len(jobs))
+    renderTime = 0.0
+    while alive > 0:
+        workerID, message = messages.get()
+        if message["type"] == "exit":
+            alive -= 1
+            if workerID in idle:
+                idle.remove(workerID)
+            if workerID in running:
+                print("Worker "+str(workerID)+" exited during "+json.dumps(running[workerID])+", the job is queued again")
+                pending.append(running.pop(workerID))
+        else:
+            if message["type"] == "done":
+                running.pop(workerID, None)
+                ledger.record(message["index"], message["frame"], message["file"])
+                progress.step()
+                renderTime += message["seconds"]
+                print("{} frame {} in {:.1f} s | {}, {:.2f}x parallel speedup".format(
+                      message["camera"], message["frame"], message["seconds"], progress.getStatus(), renderTime/progress.getElapsed()))
+            idle.append(workerID)
+        while pending and idle:
+            idleID = idle.pop()
+            running[idleID] = pending.pop()
+            sendMessage(workers[idleID], running[idleID])
+        if not pending and not running:
+            for idleID in idle:
+                sendMessage(workers[idleID], {"type": "quit"})
+            idle = []
+    for process in workers:
+        process.wait()
+    print("Rendered {} of {} jobs in {} with {} workers".format(progress.done, len(jobs), formatDuration(progress.getElapsed()), len(workers)))
+    return progress.done == len(jobs)
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel LF renderer")
+    parser.add_argument("blend", help="saved .blend file with the LF cameras")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 1)//4), help="number of Blender processes")
+    parser.add_argument("--blender", default="blender", help="Blender executable")
+    parser.add_argument("--threads", type=int, default=0, help="render threads of each worker, by default the cores are split between the workers")
+    parser.add_argument("--no-cpu", dest="cpu", action="store_false", help="do not force Cycles to render on CPU")
+    parser.add_argument("--restart", action="store_true", help="render all views again instead of resuming from the ledger")
+    args = parser.parse_args()
+    if args.threads == 0:
+        args.threads = max(1, (os.cpu_count() or 1)//args.workers)
+
+    listing = getJobs(args)
+    jobs = listing["jobs"]
+    if not jobs:
+        if listing.get("finished"):
+            print("All "+str(listing["finished"])+" views are already rendered")
+        else:
+            print("No LF camera array in "+args.blend)
+        return
+    if listing["finished"]:
+        print("Resuming, "+str(listing["finished"])+" views are already rendered and "+str(len(jobs))+" remain")
+    # The ledger was already reset by the listing when restarting
+    ledger = RenderLedger(listing["path"], listing["settings"])
+    if not dispatch(args, jobs, ledger):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    if bpy is None:
+        main()
+    elif "--worker" in sys.argv:
+        runWorker()
+    elif "--list" in sys.argv:
+        listJobs()
@@ -0,0 +1,139 @@
+""" Image access shared by the LF scripts, has to be placed next to them.
+    Images are read into float32 NumPy arrays (rows, columns, channels) with foreach_get, the rows are in the Blender order (bottom to top).
+"""
+import bpy
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+
+# Decodes images without Blender so that it can run in threads, optional
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+# Memory available for the decoded images kept by the shared cache
+CACHE_BYTES = 1 << 30
+
+def readImage(image):
+    pixels = np.empty(image.size[0]*image.size[1]*image.channels, dtype=np.float32)
+    image.pixels.foreach_get(pixels)
+    return pixels.reshape(image.size[1], image.size[0], image.channels)
+
+def loadImage(path):
+    """ Decodes the image file without keeping it in the Blender data.
+    """
+    image = bpy.data.images.load(path)
+    try:
+        return readImage(image)
+    finally:
+        image.buffers_free()
+        bpy.data.images.remove(image)
+
+def openBuffer(path):
+    # Blender keeps the alpha of the files unassociated
+    config = oiio.ImageSpec()
+    config.attribute("oiio:UnassociatedAlpha", 1)
+    return oiio.ImageBuf(path, 0, 0, config)
+
+def imageSize(path):
+    """ Returns the width and height of the image file, only the header is read by OpenImageIO.
+    """
+    if oiio is not None:
+        imageInput = oiio.ImageInput.open(path)
+        if imageInput is not None:
+            spec = imageInput.spec()
+            imageInput.close()
+            return [spec.width, spec.height]
+    image = bpy.data.images.load(path)
+    try:
+        return list(image.size)
+    finally:
+        bpy.data.images.remove(image)
+
+def decodeImage(path, channels=4):
+    """ Decodes the image file by OpenImageIO, can be called from threads. The result has the same layout as readImage.
+        The values are not color managed, see decodeMatches.
+    """
+    buffer = openBuffer(path)
+    pixels = buffer.get_pixels(oiio.FLOAT)
+    if buffer.has_error:
+        raise RuntimeError(buffer.geterror())
+    pixels = pixels.reshape(pixels.shape[0], pixels.shape[1], -1)[::-1]
+    result = np.ones((pixels.shape[0], pixels.shape[1], channels), dtype=np.float32)
+    if pixels.shape[2] < 3:
+        # Gray with optional alpha
+        result[:, :, :3] = pixels[:, :, :1]
+        if pixels.shape[2] == 2:
+            result[:, :, 3] = pixels[:, :, 1]
+    else:
+        count = min(pixels.shape[2], channels)
+        result[:, :, :count] = pixels[:, :, :count]
+    return result
+
+def decodeMatches(path):
+    """ Checks that decodeImage gives the same pixels as loadImage for the file and the files of the same format.
+        Only 8 bit PNG and JPEG, which Blender keeps encoded, and RGB(A) EXR, which is linear, are decoded the same way. The pixels are compared too.
+    """
+    if oiio is None:
+        return False
+    buffer = openBuffer(path)
+    spec = buffer.spec()
+    byteImage = buffer.file_format_name in ("png", "jpeg") and spec.format == oiio.UINT8
+    floatImage = buffer.file_format_name == "openexr" and tuple(spec.channelnames) in (("R", "G", "B"), ("R", "G", "B", "A"))
+    if not byteImage and not floatImage:
+        return False
+    decoded = decodeImage(path)
+    loaded = loadImage(path)
+    return decoded.shape == loaded.shape and np.allclose(decoded, loaded, atol=1.0/255)
+
+def saveImage(pixels, width, height, path):
+    image = bpy.data.images.new("pixelImage", width=width, height=height)
+    image.pixels.foreach_set(np.asarray(pixels, dtype=np.float32).ravel())
+    image.update()
+    image.save_render(path)
+    image.buffers_free()
+    bpy.data.images.remove(image)
+
+class ImageCache:
+    """ Decoded images kept in the least recently used order, the oldest ones are dropped when the size exceeds maxBytes.
+        The images are identified by the path and modification time so re-rendered files are loaded again.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        key = (path, os.path.getmtime(path))
+        with self.lock:
+            pixels = self.images.get(key)
+            if pixels is not None:
+                self.images.move_to_end(key)
+                return pixels
+        pixels = loadImage(path)
+        with self.lock:
+            if key not in self.images:
+                self.images[key] = pixels
+                self.size += pixels.nbytes
+            while self.size > self.maxBytes and len(self.images) > 1:
+                self.size -= self.images.popitem(last=False)[1].nbytes
+        return pixels
+
+    def getRows(self, path, y0, y1):
+        return self.get(path)[y0:y1]
+
+    def getTile(self, path, x0, y0, x1, y1):
+        return self.get(path)[y0:y1, x0:x1]
+
+    def getPixel(self, path, x, y):
+        return self.get(path)[y, x]
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.size = 0
+
+cache = ImageCache(CACHE_BYTES)
@@ -1,14 +1,34 @@
 import bpy
 import os
+import sys
 import shutil
 import mathutils
 import math
-from functools import reduce
+import json
+import numpy as np
+
+# The image access shared by the LF scripts is in lfImages.py next to this file
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import lfImages
 
 sampleDensity = 3
 sampleDistance = 0.1
 renderInfo = bpy.data.scenes["Scene"].render
 tempRenderFile = bpy.app.tempdir+"test.png"
+tempViewsPath = bpy.app.tempdir+"views/"
+# Store the samples of all pixels in one array file instead of one image per pixel
+packedOutput = True
+# Pixels in a square tile of the packed array, the samples of the pixels of one tile are stored together
+packedTile = 16
+# Memory-mapped array with all decoded views used by sortPixels
+stagingFile = bpy.app.tempdir+"views.npy"
+# Render each view only once and sort the pixels in memory instead of rendering all views for each row
+renderOnce = True
+# Bytes of the pixel blocks sorted at once, the staged views are read in chunks of rows fitting in this budget
+sortMemory = 512 << 20
+# Disparities in pixels between neighboring views tested by the plane sweep in analyze
+maxDisparity = 8.0
+disparitySteps = 17
 originalFilePath = renderInfo.filepath
 
 def imagePath(x,y,path=originalFilePath,prefix=""):
@@ -17,25 +37,152 @@ def imagePath(x,y,path=originalFilePath,prefix=""):
 def clamp(x):
     return max(min(x, 1.0), 0.0)
 
-def getPixel(x,y,image):
-    i = (y * image.size[0] + x ) * 4
-    return (image.pixels[i], image.pixels[i+1], image.pixels[i+2])
-
-def writePixel(x,y,pixels,rx,value):
-    i = (y * rx + x ) * 4
-    pixels[i] = value[0]
-    pixels[i+1] = value[1]
-    pixels[i+2] = value[2]
+def getPixel(x,y,pixels):
+    return pixels[y, x, :3]
 
 def saveImagePixels(pixels, width, height, path):
-    pixelImage = bpy.data.images.new("pixelImage", width=width, height=height)
-    pixelImage.pixels[:] = pixels
-    pixelImage.update()
-    pixelImage.save_render(path)
-    pixelImage.buffers_free()
-    bpy.data.images.remove(pixelImage)       
-         
+    lfImages.saveImage(pixels, width, height, path)
+
+def packedPaths(path):
+    path = bpy.path.abspath(path)
+    return path+"samples.npy", path+"samples.json"
+
+def createPacked(path):
+    # The samples of all pixels of a tile are one block so the samples of a pixel are close to each other and a view is read by tile-sized runs
+    # The resolution is padded to whole tiles, the header is a JSON file next to the array
+    arrayFile, headerFile = packedPaths(path)
+    tilesX = -(-renderInfo.resolution_x // packedTile)
+    tilesY = -(-renderInfo.resolution_y // packedTile)
+    header = {"sampleDensity": sampleDensity, "sampleDistance": sampleDistance,
+              "resolution": [renderInfo.resolution_x, renderInfo.resolution_y], "channels": 4,
+              "tileSize": [packedTile, packedTile], "tiles": [tilesX, tilesY],
+              "layout": ["tileY", "tileX", "sampleY", "sampleX", "tileRow", "tileColumn", "channel"]}
+    with open(headerFile, "w") as file:
+        json.dump(header, file, indent=1)
+    return np.lib.format.open_memmap(arrayFile, mode="w+", dtype=np.float32,
+                                     shape=(tilesY, tilesX, sampleDensity, sampleDensity, packedTile, packedTile, 4))
+
+def getPackedPixel(samples, x, y):
+    # Returns the N x N x C samples of the pixel from the packed array
+    tileHeight, tileWidth = samples.shape[4:6]
+    return np.array(samples[y // tileHeight, x // tileWidth, :, :, y % tileHeight, x % tileWidth])
+
+def getPackedView(samples, header, x, y):
+    # Returns the H x W x C view assembled from the tiles of the packed array
+    width, height = header["resolution"]
+    tilesY, tilesX, _, _, tileHeight, tileWidth, channels = samples.shape
+    view = np.array(samples[:, :, y, x]).transpose(0, 2, 1, 3, 4)
+    return view.reshape(tilesY*tileHeight, tilesX*tileWidth, channels)[:height, :width]
+
+def openPacked(path):
+    arrayFile, headerFile = packedPaths(path)
+    with open(headerFile) as file:
+        header = json.load(file)
+    return np.load(arrayFile, mmap_mode="r"), header
+
+def stageViews(inputPath, stagingFile):
+    # Each view is decoded only once into a (views, H, W, C) array on disk
+    views = np.lib.format.open_memmap(stagingFile, mode="w+", dtype=np.float32,
+                                      shape=(sampleDensity*sampleDensity, renderInfo.resolution_y, renderInfo.resolution_x, 4))
+    for x in range(sampleDensity):
+        for y in range(sampleDensity):
+            views[y*sampleDensity+x] = lfImages.loadImage(imagePath(x,y,inputPath))
+    views.flush()
+    return views
+
+def sortStaged(views, outputPath):
+    # The staged views are read in blocks of rows fitting in sortMemory and reordered so that the samples of each pixel (or tile of pixels in the packed array) are together
+    count, height, width, channels = views.shape
+    rowBytes = count*width*channels*4
+    chunkRows = max(1, min(height, sortMemory // rowBytes))
+    packed = createPacked(outputPath) if packedOutput else None
+    if packed is not None:
+        # The chunks are whole rows of tiles
+        chunkRows = max(packedTile, chunkRows // packedTile * packedTile)
+    for r0 in range(0, height, chunkRows):
+        r1 = min(r0+chunkRows, height)
+        samples = np.array(views[:, r0:r1])
+        samples[..., 3] = 1.0
+        samples = samples.reshape(sampleDensity, sampleDensity, r1-r0, width, channels)
+        if packed is not None:
+            tilesY, tilesX = -(-(r1-r0) // packedTile), packed.shape[1]
+            tiles = np.zeros((sampleDensity, sampleDensity, tilesY*packedTile, tilesX*packedTile, channels), dtype=np.float32)
+            tiles[:, :, :r1-r0, :width] = samples
+            tiles = tiles.reshape(sampleDensity, sampleDensity, tilesY, packedTile, tilesX, packedTile, channels)
+            packed[r0 // packedTile:r0 // packedTile+tilesY] = tiles.transpose(2, 4, 0, 1, 3, 5, 6)
+            continue
+        blocks = samples.transpose(2, 3, 0, 1, 4)
+        for ry in range(r0, r1):
+            for p in range(width):
+                saveImagePixels(blocks[ry-r0, p].ravel(),sampleDensity,sampleDensity,imagePath(p,ry,outputPath))
+    if packed is not None:
+        packed.flush()
+
+def sweepDisparity(luminance, r0, r1, h0, offsets):
+    # Each view is shifted by its offset from the grid center times the tested disparity, the most consistent disparity has the lowest variance
+    count, haloRows, width = luminance.shape
+    rows = np.arange(r0, r1)
+    columns = np.arange(width)
+    bestCost = np.full((r1-r0, width), np.inf, dtype=np.float32)
+    bestDisparity = np.zeros((r1-r0, width), dtype=np.float32)
+    for disparity in np.linspace(-maxDisparity, maxDisparity, disparitySteps):
+        total = np.zeros((r1-r0, width), dtype=np.float32)
+        totalSq = np.zeros((r1-r0, width), dtype=np.float32)
+        for v in range(count):
+            ys = np.clip(rows+int(round(offsets[v][1]*disparity)), h0, h0+haloRows-1)-h0
+            xs = np.clip(columns+int(round(offsets[v][0]*disparity)), 0, width-1)
+            shifted = luminance[v][ys][:, xs]
+            total += shifted
+            totalSq += shifted*shifted
+        cost = totalSq/count-(total/count)**2
+        better = cost < bestCost
+        bestCost[better] = cost[better]
+        bestDisparity[better] = disparity
+    return bestDisparity, bestCost
+
+def analyze(inputPath, outputPath):
+    # Per-pixel statistics across all views computed in chunks of rows, saved as images and as raw values in statistics.npz
+    views = stageViews(inputPath, stagingFile)
+    count, height, width, channels = views.shape
+    grid = np.arange(sampleDensity)-(sampleDensity-1)/2
+    offsets = [(grid[v % sampleDensity], grid[v // sampleDensity]) for v in range(count)]
+    halo = int(math.ceil(maxDisparity*grid[-1]))
+    stats = {name: np.zeros((height, width, 3), dtype=np.float32) for name in ("mean", "variance", "min", "max")}
+    stats["disparity"] = np.zeros((height, width), dtype=np.float32)
+    stats["consistency"] = np.zeros((height, width), dtype=np.float32)
+    rowBytes = count*width*channels*4
+    chunkRows = max(1, min(height, sortMemory // rowBytes))
+    for r0 in range(0, height, chunkRows):
+        r1 = min(r0+chunkRows, height)
+        samples = np.array(views[:, r0:r1, :, :3])
+        stats["mean"][r0:r1] = samples.mean(axis=0)
+        stats["variance"][r0:r1] = samples.var(axis=0)
+        stats["min"][r0:r1] = samples.min(axis=0)
+        stats["max"][r0:r1] = samples.max(axis=0)
+        del samples
+        h0 = max(r0-halo, 0)
+        h1 = min(r1+halo, height)
+        luminance = np.array(views[:, h0:h1, :, :3]) @ np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+        stats["disparity"][r0:r1], stats["consistency"][r0:r1] = sweepDisparity(luminance, r0, r1, h0, offsets)
+    del views
+    os.remove(stagingFile)
+
+    np.savez(bpy.path.abspath(outputPath)+"statistics.npz", **stats)
+    # The disparity is mapped from the tested range to 0-1 for the image
+    images = dict(stats)
+    images["disparity"] = (stats["disparity"]+maxDisparity)/(2*maxDisparity)
+    for name, values in images.items():
+        pixels = np.ones((height, width, 4), dtype=np.float32)
+        pixels[:, :, :3] = values if values.ndim == 3 else values[:, :, None]
+        saveImagePixels(pixels.ravel(), width, height, outputPath+name+renderInfo.file_extension)
+
 def renderSamplesAndSort():
+    if renderOnce:
+        renderSamplesFull(tempViewsPath)
+        sortPixels(tempViewsPath, originalFilePath)
+        shutil.rmtree(tempViewsPath)
+        renderInfo.filepath = originalFilePath
+        return
     #maybe copy camera and then delete to keep the original one in case of errors
     camera = bpy.context.scene.camera
     originalBasis = camera.matrix_basis
@@ -46,7 +193,7 @@ def renderSamplesAndSort():
     renderInfo.use_crop_to_border = False
     
     for ry in range(renderInfo.resolution_y):
-        pixels = [reduce(lambda x,y:x+y,[[0.0,0.0,0.0,1.0] for i in range(sampleDensity*sampleDensity)]) for i in range(renderInfo.resolution_x)]
+        pixels = np.ones((renderInfo.resolution_x, sampleDensity, sampleDensity, 4), dtype=np.float32)
         renderPadding = 0.03
         renderInfo.border_max_x = 1.0
         renderInfo.border_max_y = clamp(ry/renderInfo.resolution_y+renderPadding)
@@ -58,15 +205,10 @@ def renderSamplesAndSort():
                 camera.matrix_basis = cornerBasis @ mathutils.Matrix.Translation((x*sampleDistance, y*sampleDistance, 0.0))
                 renderInfo.filepath = tempRenderFile
                 bpy.ops.render.render( write_still=True )
-                image = bpy.data.images.load(tempRenderFile)
-                for rx in range(renderInfo.resolution_x):
-                    pixel = getPixel(rx, ry, image)
-                    writePixel(x, y, pixels[rx], sampleDensity, pixel)       
-                image.buffers_free()        
-                bpy.data.images.remove(image)
+                pixels[:, y, x, :3] = lfImages.loadImage(tempRenderFile)[ry, :, :3]
 
         for p in range(renderInfo.resolution_x):
-                saveImagePixels(pixels[p],sampleDensity,sampleDensity,imagePath(p,ry))      
+                saveImagePixels(pixels[p].ravel(),sampleDensity,sampleDensity,imagePath(p,ry))      
          
     renderInfo.filepath = originalFilePath
     camera.matrix_basis = originalBasis
@@ -88,29 +230,24 @@ def renderSamplesFull(path):
             bpy.ops.render.render( write_still=True )
     camera.matrix_basis = originalBasis
 
-def sortPixels(inputPath, outputPath):    
-    for ry in range(renderInfo.resolution_y):
-        pixels = [reduce(lambda x,y:x+y,[[0.0,0.0,0.0,1.0] for i in range(sampleDensity*sampleDensity)]) for i in range(renderInfo.resolution_x)]
-        for x in range(sampleDensity):
-            for y in range(sampleDensity):
-                image = bpy.data.images.load(inputPath + imagePath(x,y))
-                for rx in range(renderInfo.resolution_x):
-                    pixel = getPixel(rx, ry, image)
-                    writePixel(x, y, pixels[rx], sampleDensity, pixel)       
-                image.buffers_free()        
-                bpy.data.images.remove(image)                
-        for p in range(renderInfo.resolution_x):
-                saveImagePixels(pixels[p],sampleDensity,sampleDensity,imagePath(p,ry,outputPath))    
+def sortPixels(inputPath, outputPath):
+    views = stageViews(inputPath, stagingFile)
+    sortStaged(views, outputPath)
+    del views
+    os.remove(stagingFile)
 
 def reconstruct(x,y,inputPath):
-    pixels = reduce(lambda x,y:x+y,[[0.0,0.0,0.0,1.0] for i in range(renderInfo.resolution_x*renderInfo.resolution_y)])
+    if os.path.exists(packedPaths(inputPath)[0]):
+        # Only the samples of the view are read from each tile of the packed array
+        samples, header = openPacked(inputPath)
+        width, height = header["resolution"]
+        saveImagePixels(getPackedView(samples, header, x, y).ravel(), width, height, imagePath(x,y,prefix="reconstructed"))
+        return
+    pixels = np.ones((renderInfo.resolution_y, renderInfo.resolution_x, 4), dtype=np.float32)
     for px in range(renderInfo.resolution_x):
             for py in range(renderInfo.resolution_y):
-                image = bpy.data.images.load(imagePath(px,py,inputPath))
-                writePixel(px,py,pixels,renderInfo.resolution_x,getPixel(x,y,image))
-                image.buffers_free()  
-                bpy.data.images.remove(image)
-    saveImagePixels(pixels,renderInfo.resolution_x,renderInfo.resolution_y, imagePath(x,y,prefix="reconstructed"))
+                pixels[py, px, :3] = getPixel(x,y,lfImages.cache.get(imagePath(px,py,inputPath)))
+    saveImagePixels(pixels.ravel(),renderInfo.resolution_x,renderInfo.resolution_y, imagePath(x,y,prefix="reconstructed"))
     
 try:
     #renderSamplesAndSort()
@@ -122,6 +259,7 @@ try:
     renderSamplesFull(renderPath)
     #sortPixels("/home/ichlubna/Downloads/lego/", sortPath)
     #reconstruct(2,2,sortPath)
+    #analyze(renderPath, renderPath)
 except Exception as e:
     renderInfo.filepath = originalFilePath
     print(e)
@@ -1,16 +1,18 @@
 import bpy
-import random
-import math
 import gpu
 import numpy as np
 import mathutils
-import bl_math
 from gpu_extras.batch import batch_for_shader
 import nodeitems_utils
 from nodeitems_builtins import CompositorNodeCategory
-from multiprocessing import Pool
 
 import time
+import os
+import sys
+
+# The Blender independent part is in lightningCore.py next to this file
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from lightningCore import computeMasks, bakeFrame, getWorkerPool, closeWorkerPool, LRUCache, StageTimer, Trajectory, CoalescingWorker
 
 
 bl_info = {
@@ -31,190 +33,319 @@ bl_info = {
 }
 
 
+# Memory available for the cached bolt geometry and masks of one node
+CACHE_BYTES = 256 << 20
+nodeStates = {}
+# Seconds without any edit after which the proxy preview is refined to the full resolution
+REFINE_DELAY = 0.5
+# Computes the masks of the nodes updated in the background, the results are applied by applyResults
+backgroundWorker = CoalescingWorker()
+# Seconds between the checks for finished background updates
+APPLY_INTERVAL = 0.05
+applyRegistered = False
+# Color space of the node and bake images, the masks are stored as linear values
+LINEAR_COLORSPACE = "Linear Rec.709"
+
+class NodeState:
+    """ Data of one node kept between the updates: the cache, the track trajectories and the pixel buffer of the node image with the currently drawn mask.
+    """
+    def __init__(self):
+        self.cache = LRUCache(CACHE_BYTES)
+        self.trajectories = {}
+        self.buffer = None
+        # Pointer of the image holding the buffer, the buffer is uploaded again to a different image datablock
+        self.image = None
+        self.masks = []
+        self.analytic = False
+        self.lastEdit = 0.0
+        self.refineScheduled = False
+        self.timer = None
+
+def setupImage(img, analytic):
+    """ Only the smooth analytic glow needs the float buffer not to band, the blur mode mask is 0 or 1.
+        The alpha channel stores the analytic glow and the values are linear. Also updates the images of the nodes from older files.
+    """
+    if img.source == 'GENERATED' and img.use_generated_float != analytic:
+        img.use_generated_float = analytic
+    img.alpha_mode = 'CHANNEL_PACKED'
+    img.colorspace_settings.name = LINEAR_COLORSPACE
+
+def getBoltNode(bolt):
+    """ Returns the node owning the bolt in its bolts collection.
+    """
+    return bolt.id_data.path_resolve(bolt.path_from_id().rsplit(".", 1)[0])
+
+class LightningBolt(bpy.types.PropertyGroup):
+    """ Additional bolt of the node with its own static endpoints and seed, the other settings are shared with the main bolt.
+    """
+    def update_bolt(self, context):
+        getBoltNode(self).update_effect(context)
+
+    startX: bpy.props.IntProperty(name="Start X", update=update_bolt)
+    startY: bpy.props.IntProperty(name="Start Y", update=update_bolt)
+    endX: bpy.props.IntProperty(name="End X", update=update_bolt)
+    endY: bpy.props.IntProperty(name="End Y", update=update_bolt)
+    seed: bpy.props.IntProperty(name="Seed", min=0, default=0, update=update_bolt)
+
 class LightningGen (bpy.types.CompositorNodeCustomGroup):
 
     bl_name = 'LightningGen'
     bl_label = 'Lightning'        
 
-    def generateBolt(self, p0, p1):
-        # TODO add spatially consistent random generator so that moving the bolt doesn't change shape rapidly
-        # https://docs.blender.org/api/current/mathutils.noise.html
-        class Lines:
-            class Segment:
-                p0 = 0
-                p1 = 0
-                level = 0
-                def __init__(self, a, b, l):
-                    self.p0 = a
-                    self.p1 = b
-                    self.level = l
-            maxLevel = 0
-            segments = []
-            vertices = []
-            initP0 = []
-            initP1 = []
-            initDirection = []
-            initLength = 0
-            def __init__(self, p0, p1):
-                self.initP0 = p0
-                self.initP1 = p1
-                self.initDirection = p1-p0
-                self.initLength = np.linalg.norm(self.initDirection)
-                self.addVertex(p0)
-                self.addVertex(p1)
-                self.addLine(0,1,0)  
-            def removeSegment(self, i):
-                del self.segments[i]
-            def getCoords(self,s):
-                return [(self.vertices[s.p0], self.vertices[s.p1])]
-            def addLine(self, a, b, level):
-                    if level > self.maxLevel:
-                        self.maxLevel = level
-                    self.segments.append(self.Segment(a, b, level))
-            def addVertex(self, v):
-                self.vertices.append(v)
-                return len(self.vertices)-1
-            def getMaxLevel(self):
-                return self.maxLevel;
-            def getInitPts(self):
-                return (self.initP1, self.initP0)
-            def getInitLength(self):
-                return self.initLength
-            def getInitDirection(self):
-                return self.initDirection
-        
-        lines = Lines(p0,p1)     
-        length = lines.getInitLength()
-        random.seed(self.seed)
-        randRange = int((1.0-self.stability)*int(length))
-        for i in range(0, self.complexity):
-            for si in range (0, len(lines.segments)):
-                segment = lines.segments[si]
-                pts = lines.getCoords(segment)[0]
-                vector = pts[1]-pts[0]
-                normal = np.array([vector[1], -vector[0]])
-                normal = normal/np.linalg.norm(normal, ord=1)   
-                randOffset = normal*random.randint(-randRange, randRange)
-                midpoint = ((pts[0]+pts[1])/2)+randOffset
-                midpointID = lines.addVertex(midpoint)
-                
-                if random.uniform(0.0, 1.0) < self.forking and i < int(self.complexity/2):
-                    forkDirection = midpoint-pts[0]
-                    angle = random.uniform(0.1, 1.55*self.maxForkAngle)
-                    if random.uniform(0.0, 1.0) > 0.5:
-                        angle = -angle
-                    cosVal = math.cos(angle)
-                    sinVal = math.sin(angle)
-                    csd = np.array([cosVal, -sinVal])*forkDirection
-                    scd = np.array([sinVal, cosVal])*forkDirection
-                    forkEnd = midpoint+np.array([np.sum(csd), np.sum(scd)]) 
-                    forkEndID = lines.addVertex(forkEnd)
-                    lines.addLine(midpointID, forkEndID, segment.level+1)
-                
-                lines.addLine(segment.p0, midpointID, segment.level)
-                lines.addLine(midpointID, segment.p1, segment.level)
-                lines.removeSegment(si)
-            randRange = int(randRange/2)
-        return lines
-
-    def drawBolt(self, lines, pixels, coord, w, h):
-        bitmap = [0.0, 0.0, 0.0, 1.0]*(w*h)
-        def drawLine(start, end, thickness):
-            def scaleRadius(radius, point, start, end, scale):
-                if (scale == 1.0):
-                    return radius
-                maxDistMultiplier = 1.0
-                maxDist = math.dist((coord[0], coord[1]), (coord[2], coord[3]))*maxDistMultiplier
-                currentDist = math.dist(point, (coord[0], coord[1]))
-                if(currentDist == 0.0):
-                    return radius
-                return int(round((currentDist/maxDist)*scale*radius+radius))
-
-            def setPixel(x, y):
-                if (0 <= x < w) and (0 <= y < h):
-                    offset = (x + int(y*w))*4
-                    for i in range(4):
-                        try:
-                            bitmap[offset+i] = 1.0
-                        except:
-                            {}
-
-            def drawPoint(x, y, thickness):
-                radius = scaleRadius(thickness, [x,y], start, end, self.perspectiveScale)
-                for X in range(-radius, radius+1):
-                    for Y in range(-radius, radius+1):
-                        if(X*X+Y*Y <= radius*radius):
-                            setPixel(X+x, Y+y)                        
-
-            # Bressenham
-            dx = abs(end[0] - start[0])
-            dy = abs(end[1] - start[1])
-            x, y = start[0], start[1]
-            sx = -1 if start[0] > end[0] else 1
-            sy = -1 if start[1] > end[1] else 1
-            if dx > dy:
-                err = dx / 2.0
-                while x != end[0] and (0 <= x < w):
-                    drawPoint(x, y, thickness)
-                    err -= dy
-                    if err < 0:
-                        y += sy
-                        err += dx
-                    x += sx
+    def getSettings(self):
+        """ Returns the properties affecting the bolt as a dictionary which can be used outside of the main thread.
+        """
+        return {"seed": self.seed, "complexity": self.complexity, "stability": self.stability, "forking": self.forking,
+                "maxForkAngle": self.maxForkAngle, "thickness": self.thickness, "falloff": self.falloff, "perspectiveScale": self.perspectiveScale,
+                "glowMode": self.glowMode, "glow": self.glow, "coreBlur": self.coreBlur}
+
+    def drawBolt(self, masks, img):
+        """ Clears the boxes of the previously drawn bolts in the persistent buffer, draws the new ones and uploads the buffer if anything changed.
+            Overlapping bolts are combined by the maximum. The analytic glow is stored in the alpha channel.
+        """
+        state = self.getState()
+        w, h = img.size
+        analytic = self.glowMode == 'ANALYTIC'
+        if len(masks) != 0:
+            analytic = masks[0][1].ndim == 3
+        if state.buffer is None or state.buffer.shape != (h, w, 4) or state.analytic != analytic or state.image != img.as_pointer():
+            setupImage(img, analytic)
+            state.buffer = np.zeros((h, w, 4), dtype=np.float32)
+            state.buffer[:, :, 3] = 0.0 if analytic else 1.0
+            state.analytic = analytic
+            state.image = img.as_pointer()
+            state.masks = []
+        elif len(state.masks) == len(masks) and all(old is new for old, new in zip(state.masks, masks)):
+            return False
+        for rect, region in state.masks:
+            if rect is not None:
+                x0, y0, x1, y1 = rect
+                state.buffer[y0:y1, x0:x1, :3] = 0.0
+                if analytic:
+                    state.buffer[y0:y1, x0:x1, 3] = 0.0
+        for rect, region in masks:
+            if rect is None:
+                continue
+            x0, y0, x1, y1 = rect
+            if analytic:
+                np.maximum(state.buffer[y0:y1, x0:x1, :3], region[:, :, 0, None], out=state.buffer[y0:y1, x0:x1, :3])
+                np.maximum(state.buffer[y0:y1, x0:x1, 3], region[:, :, 1], out=state.buffer[y0:y1, x0:x1, 3])
             else:
-                err = dy / 2.0
-                while y != end[1] and (0 <= y < h):
-                    drawPoint(x, y, thickness)
-
-                    err -= dx
-                    if err < 0:
-                        x += sx
-                        err += dy
-                    y += sy
-            drawPoint(x, y, thickness)
-            
-        for segment in lines.segments:
-            pts = lines.getCoords(segment)[0]
-            width = int(bl_math.clamp(self.thickness*(1.0-(segment.level/(self.falloff*lines.getMaxLevel()))), 0, self.thickness))
-            drawLine((int(pts[0][0]), int(pts[0][1])), (int(pts[1][0]), int(pts[1][1])), width)
-        pixels.foreach_set(bitmap)
-                    
-    def drawBoltGPU(self, lines, pixels, coord, w, h):
-        print("Not implemented.")
-
-    def update_effect(self, context):
+                np.maximum(state.buffer[y0:y1, x0:x1, :3], region[:, :, None], out=state.buffer[y0:y1, x0:x1, :3])
+        state.masks = masks
+        img.pixels.foreach_set(state.buffer.ravel())
+        return True
+
+    def getState(self):
+        if self.name not in nodeStates:
+            nodeStates[self.name] = NodeState()
+        return nodeStates[self.name]
+
+    def getTrajectory(self, inputNode):
+        """ Returns the trajectory of the track used by the track position node, it is rebuilt only when the markers, clip size or frame range change.
+        """
         scene = bpy.context.scene
-        img = bpy.data.images[self.name]
+        markers = inputNode.clip.tracking.tracks[inputNode.track_name].markers
+        count = len(markers)
+        frames = np.empty(count, dtype=np.int32)
+        markers.foreach_get("frame", frames)
+        coords = np.empty(count*2, dtype=np.float32)
+        markers.foreach_get("co", coords)
+        mute = np.empty(count, dtype=bool)
+        markers.foreach_get("mute", mute)
+        frames = frames[~mute]
+        coords = coords.reshape(-1, 2)[~mute]
+        if len(frames) == 0:
+            return None
+        size = tuple(inputNode.clip.size)
+        key = (inputNode.clip.name, inputNode.track_name)
+        trajectories = self.getState().trajectories
+        trajectory = trajectories.get(key)
+        if trajectory is None or not trajectory.matches(frames, coords, size, scene.frame_start, scene.frame_end):
+            trajectory = Trajectory(frames, coords, size, scene.frame_start, scene.frame_end)
+            trajectories[key] = trajectory
+        return trajectory
+
+    def getCoords(self, frame):
+        """ Returns the start and end point of the bolt, linked track position nodes are evaluated in the given frame.
+        """
         coords = [0, 0, 0, 0]
         inputs = ['Start X', 'Start Y', 'End X', 'End Y']
+        trajectories = {}
         for i in range(len(inputs)):
             coords[i] = self.inputs[inputs[i]].default_value
             if len(self.inputs[inputs[i]].links) != 0:
                 inputNode = self.inputs[inputs[i]].links[0].from_node
                 if isinstance(inputNode, bpy.types.CompositorNodeTrackPos):
-                    markerPosition = inputNode.clip.tracking.tracks[inputNode.track_name].markers.find_frame(bpy.context.scene.frame_current).co
-                    xy = 1
-                    if i % 2 == 0:
-                        xy = 0
-                    coords[i] = int(markerPosition[xy]*inputNode.clip.size[xy])
+                    if inputNode.name not in trajectories:
+                        trajectories[inputNode.name] = self.getTrajectory(inputNode)
+                    trajectory = trajectories[inputNode.name]
+                    if trajectory is not None:
+                        coords[i] = int(trajectory.getPosition(frame)[i % 2])
                 else:
                     bpy.context.scene.node_tree.links.remove(self.inputs[inputs[i]].links[0])
-        if(abs(coords[0]-coords[2]) + abs(coords[1]-coords[3]) < 0.0001):
+        return coords
+
+    def getBolts(self, frame):
+        """ Returns the (coords, seed) pairs of the main bolt and the additional bolts.
+        """
+        bolts = [(self.getCoords(frame), self.seed)]
+        for bolt in self.bolts:
+            bolts.append(([bolt.startX, bolt.startY, bolt.endX, bolt.endY], bolt.seed))
+        return bolts
+
+    def getBakeDir(self):
+        return os.path.join(bpy.path.abspath(self.bakePath), bpy.path.clean_name(self.name))
+
+    def update_effect(self, context):
+        if self.useBake:
+            self.update_blur(context)
+            return
+        if self.background:
+            self.requestFrame(bpy.context.scene.frame_current, self.preview)
+        else:
+            self.drawFrame(bpy.context.scene.frame_current, self.preview)
+        self.update_blur(context)
+        return
+
+    def drawFrame(self, frame, proxy):
+        """ Draws the bolts in the node image, with proxy the bolts are rasterized at the preview resolution and refined later.
+        """
+        state = self.getState()
+        timer = StageTimer()
+        img = bpy.data.images[self.name]
+        bolts = self.getBolts(frame)
+        timer.lap("markers")
+        w, h = img.size
+        factor = int(self.previewSize) if proxy else 1
+        masks = computeMasks(state.cache, bolts, w, h, self.getSettings(), factor, self.gpuComp, timer)
+        self.applyMasks(masks, img, frame, factor, timer)
+
+    def requestFrame(self, frame, proxy):
+        """ Same as drawFrame but the mask is computed by the background worker, a newer request of the node cancels the older one.
+            Only the Blender data are read here, the result is applied from the main thread by applyResults.
+        """
+        global applyRegistered
+        state = self.getState()
+        timer = StageTimer()
+        bolts = self.getBolts(frame)
+        timer.lap("markers")
+        w, h = bpy.data.images[self.name].size
+        factor = int(self.previewSize) if proxy else 1
+        settings = self.getSettings()
+        tiled = self.gpuComp
+        tree = self.id_data
+        def job(token):
+            timer.skip()
+            masks = computeMasks(state.cache, bolts, w, h, settings, factor, tiled, timer, token)
+            return tree, masks, frame, factor, timer
+        backgroundWorker.submit(self.name, job)
+        if not applyRegistered:
+            applyRegistered = True
+            bpy.app.timers.register(applyResults, first_interval=APPLY_INTERVAL)
+
+    def applyMasks(self, masks, img, frame, factor, timer):
+        # The result may have waited for the timer of the main thread
+        timer.skip()
+        changed = self.drawBolt(masks, img)
+        timer.lap("upload")
+        if changed:
+            img.update()
+        timer.lap("update")
+        self.getState().timer = timer
+        self.logTimings(frame, factor, timer)
+        if factor != 1:
+            self.scheduleRefine()
+
+    def getTimings(self):
+        """ Returns the durations of the stages of the last update in milliseconds.
+        """
+        timer = self.getState().timer
+        if timer is None:
+            return {}
+        return dict(timer.timings)
+
+    def logTimings(self, frame, factor, timer):
+        if self.timingLog == "":
+            return
+        path = bpy.path.abspath(self.timingLog)
+        newFile = not os.path.exists(path)
+        with open(path, "a") as file:
+            if newFile:
+                file.write("time,node,frame,divisor,complexity,thickness,forking,"+",".join(StageTimer.STAGES)+",total\n")
+            values = [time.strftime("%Y-%m-%d %H:%M:%S"), self.name, frame, factor, self.complexity, self.thickness, self.forking]
+            values += [round(timer.timings[stage], 3) for stage in StageTimer.STAGES]+[round(timer.getTotal(), 3)]
+            file.write(",".join(str(v) for v in values)+"\n")
+
+    def scheduleRefine(self):
+        """ Redraws the bolt in the full resolution once there was no edit for REFINE_DELAY seconds.
+        """
+        state = self.getState()
+        state.lastEdit = time.time()
+        if state.refineScheduled:
+            return
+        state.refineScheduled = True
+        tree = self.id_data
+        name = self.name
+        def refine():
+            remaining = state.lastEdit+REFINE_DELAY-time.time()
+            if remaining > 0:
+                return remaining
+            state.refineScheduled = False
+            try:
+                node = tree.nodes.get(name)
+            except ReferenceError:
+                return None
+            if node is not None and not node.useBake:
+                if node.background:
+                    node.requestFrame(bpy.context.scene.frame_current, False)
+                else:
+                    node.drawFrame(bpy.context.scene.frame_current, False)
+            return None
+        bpy.app.timers.register(refine, first_interval=REFINE_DELAY)
+
+    def update_bake(self, context):
+        imageNode = self.node_tree.nodes.get('resultImageNode')
+        bakeImage = bpy.data.images.get(self.name+"_bake")
+        if self.useBake and bakeImage is None:
+            self.useBake = False
             return
-        start = time.time()
-        lines = self.generateBolt(np.array([coords[0],coords[1]]), np.array([coords[2],coords[3]]))
-        if(self.gpuComp):
-            self.drawBoltGPU(lines, img.pixels, coords, img.size[0], img.size[1])
+        if self.useBake:
+            imageNode.image = bakeImage
+            imageNode.frame_start = self.bakeStart
+            imageNode.frame_offset = self.bakeStart-1
+            imageNode.frame_duration = self.bakeEnd-self.bakeStart+1
         else:
-            self.drawBolt(lines, img.pixels, coords, img.size[0], img.size[1])
+            imageNode.image = bpy.data.images[self.name]
+            self.update_effect(context)
 
-        end = time.time()
-        img.update()
+    def update_glow(self, context):
+        if self.glowMode == 'ANALYTIC':
+            self.update_effect(context)
+        else:
+            self.update_blur(context)
+
+    def update_glowMode(self, context):
+        """ The analytic glow is read from the image channels directly, the blur nodes are used only in the blur mode.
+        """
+        nodes = self.node_tree.nodes
+        links = self.node_tree.links
+        imageNode = nodes.get('resultImageNode')
+        mixNode = nodes.get('mixNode')
+        colorizeNode = nodes.get('colorizeNode')
+        if self.glowMode == 'ANALYTIC':
+            links.new(imageNode.outputs['Alpha'], colorizeNode.inputs[6])
+            links.new(imageNode.outputs[0], mixNode.inputs[7])
+        else:
+            links.new(nodes.get('glowBlurNode').outputs[0], colorizeNode.inputs[6])
+            links.new(nodes.get('coreBlurNode').outputs[0], mixNode.inputs[7])
+        self.update_effect(context)
+
+    def update_blur(self, context):
         coreBlurNode = self.node_tree.nodes.get('coreBlurNode')
         coreBlurNode.inputs[1].default_value = (self.coreBlur, self.coreBlur)
         glowBlurNode = self.node_tree.nodes.get('glowBlurNode')
         glowBlurNode.inputs[1].default_value = (self.glow, self.glow)
-        return
 
     forking: bpy.props.FloatProperty(name="Forking",
                                      description="The probability of forking",
@@ -247,23 +378,60 @@ class LightningGen (bpy.types.CompositorNodeCustomGroup):
     glow: bpy.props.IntProperty(name="Glow",
                                 description="The amount of glow/light emitted by the core",
                                 min=0, max=200, default=60,
-                                update=update_effect)
+                                update=update_glow)
     coreBlur: bpy.props.IntProperty(name="Core blur",
                                     description="How sharp the core is",
                                     min=0, max=30, default=5,
-                                    update=update_effect)
+                                    update=update_glow)
+    glowMode: bpy.props.EnumProperty(name="Glow mode",
+                                     description="How the core blur and glow are computed",
+                                     items=[('BLUR', "Blur", "Blur the bolt by the compositor"),
+                                            ('ANALYTIC', "Analytic", "Compute the falloff from the distance to the bolt together with the bolt (faster for wide glows)")],
+                                     default='BLUR',
+                                     update=update_glowMode)
     seed: bpy.props.IntProperty(name="Seed",
                                 description="Random seed affecting the shape of the bolt",
                                 min=0, default=0,
                                 update=update_effect)
-    gpuComp: bpy.props.BoolProperty(name="GPU compute",
-                                description="Use GPU acceleration (good for very thick and complex bolts)",
+    gpuComp: bpy.props.BoolProperty(name="Parallel compute",
+                                description="Rasterize tiles of the bolt on all CPU cores (good for very thick and complex bolts)",
                                 default=0,
                                 update=update_effect)
+    background: bpy.props.BoolProperty(name="Background update",
+                                       description="Compute the bolt in a background thread so that the interface does not freeze while editing",
+                                       default=1,
+                                       update=update_effect)
+    preview: bpy.props.BoolProperty(name="Proxy preview",
+                                    description="Rasterize the bolt in a lower resolution while editing and refine it when the editing stops",
+                                    default=1,
+                                    update=update_effect)
+    previewSize: bpy.props.EnumProperty(name="Preview size",
+                                        description="Resolution of the proxy preview",
+                                        items=[("2", "50%", "Half resolution"), ("4", "25%", "Quarter resolution"), ("8", "12.5%", "Eighth of the resolution")],
+                                        default="4",
+                                        update=update_effect)
+    showTimings: bpy.props.BoolProperty(name="Show timings",
+                                        description="Show the duration of each stage of the last update",
+                                        default=0)
+    timingLog: bpy.props.StringProperty(name="Timing log",
+                                        description="CSV file where the stage durations of every update are appended, disabled when empty",
+                                        subtype='FILE_PATH', default="")
+    bakePath: bpy.props.StringProperty(name="Bake path",
+                                       description="Directory where the baked frames are stored, each node uses its own subdirectory",
+                                       subtype='DIR_PATH', default="//lightning/")
+    useBake: bpy.props.BoolProperty(name="Use bake",
+                                    description="Read the baked frames instead of generating the bolt",
+                                    default=0,
+                                    update=update_bake)
+    bolts: bpy.props.CollectionProperty(type=LightningBolt)
+    bakeStart: bpy.props.IntProperty(name="Bake start", default=0)
+    bakeEnd: bpy.props.IntProperty(name="Bake end", default=0)
 
     def init(self, context):
         scene = bpy.context.scene
-        bpy.data.images.new(name=self.name, width=scene.render.resolution_x, height=scene.render.resolution_y)
+        img = bpy.data.images.new(name=self.name, width=scene.render.resolution_x, height=scene.render.resolution_y,
+                                  float_buffer=self.glowMode == 'ANALYTIC')
+        setupImage(img, self.glowMode == 'ANALYTIC')
 
         self.node_tree = bpy.data.node_groups.new(self.bl_name, 'CompositorNodeTree')
         group_input = self.node_tree.nodes.new('NodeGroupInput')
@@ -346,25 +514,177 @@ class LightningGen (bpy.types.CompositorNodeCustomGroup):
         row = layout.row()
         row.prop(self, 'coreBlur', text='Core blur', slider=1)
         row = layout.row()
+        row.prop(self, 'glowMode', text='Glow mode')
+        row = layout.row()
         row.prop(self, 'seed', text='Seed')
+        for i, bolt in enumerate(self.bolts):
+            box = layout.box()
+            row = box.row(align=True)
+            row.label(text="Bolt "+str(i+2))
+            row.prop(bolt, 'seed', text='Seed')
+            remove = row.operator('node.lightning_bolt_remove', text='', icon='X')
+            remove.nodeName = self.name
+            remove.index = i
+            row = box.row(align=True)
+            row.prop(bolt, 'startX', text='Start X')
+            row.prop(bolt, 'startY', text='Y')
+            row = box.row(align=True)
+            row.prop(bolt, 'endX', text='End X')
+            row.prop(bolt, 'endY', text='Y')
         row = layout.row()
-        row.prop(self, 'gpuComp', text='GPU compute')
+        row.operator('node.lightning_bolt_add', text='Add bolt', icon='ADD').nodeName = self.name
+        row = layout.row()
+        row.prop(self, 'gpuComp', text='Parallel compute')
+        row = layout.row()
+        row.prop(self, 'background', text='Background update')
+        row = layout.row()
+        row.prop(self, 'preview', text='Proxy preview')
+        if self.preview:
+            row.prop(self, 'previewSize', text='')
+        row = layout.row()
+        row.prop(self, 'bakePath', text='')
+        row = layout.row()
+        row.operator('node.lightning_bake', text='Bake').nodeName = self.name
+        row.prop(self, 'useBake', text='Use bake')
+        if self.useBake:
+            layout.label(text="Baked frames "+str(self.bakeStart)+"-"+str(self.bakeEnd))
+        row = layout.row()
+        row.prop(self, 'showTimings', text='Show timings')
+        if self.showTimings:
+            layout.prop(self, 'timingLog', text='')
+            timings = self.getTimings()
+            col = layout.column(align=True)
+            for stage, duration in timings.items():
+                col.label(text=stage.capitalize()+": "+str(round(duration, 2))+" ms")
+            if timings:
+                col.label(text="Total: "+str(round(sum(timings.values()), 2))+" ms")
 
     def copy(self, node):
         self.init(bpy.context)
         return
 
     def free(self):
+        nodeStates.pop(self.name, None)
         bpy.data.node_groups.remove(self.node_tree, do_unlink=True)
         img = bpy.data.images[self.name]
         img.user_clear()
         bpy.data.images.remove(img)
+        bakeImage = bpy.data.images.get(self.name+"_bake")
+        if bakeImage is not None:
+            bpy.data.images.remove(bakeImage)
         #WORKAROUND TO FIX NOT UPDATING OF CUSTOM PROPERTIES
         #bpy.app.handlers.depsgraph_update_pre.remove(bpy.app.driver_namespace[self.name])
         #bpy.app.handlers.frame_change_post.remove(bpy.app.driver_namespace[self.name])
         #bpy.app.handlers.render_post.remove(bpy.app.driver_namespace[self.name])
         del bpy.app.driver_namespace[self.name]
 
+class LightningBake(bpy.types.Operator):
+    """ Renders the lightning of the node for the whole scene frame range as a 16 bit PNG sequence which is then read by the node.
+        The frames are generated in parallel by the worker processes.
+    """
+    bl_idname = "node.lightning_bake"
+    bl_label = "Bake lightning"
+    nodeName: bpy.props.StringProperty()
+
+    def execute(self, context):
+        scene = context.scene
+        node = context.space_data.edit_tree.nodes[self.nodeName]
+        if not bpy.data.filepath and node.bakePath.startswith("//"):
+            self.report({'ERROR'}, "Save the file or use an absolute bake path")
+            return {'CANCELLED'}
+        bakeDir = node.getBakeDir()
+        os.makedirs(bakeDir, exist_ok=True)
+        w, h = bpy.data.images[node.name].size
+
+        # The markers are read here since the workers have no access to Blender data
+        tasks = []
+        for frame in range(scene.frame_start, scene.frame_end+1):
+            path = os.path.join(bakeDir, str(frame).zfill(4)+".png")
+            tasks.append((path, w, h, node.getBolts(frame), node.getSettings()))
+        wm = context.window_manager
+        wm.progress_begin(0, len(tasks))
+        for i, path in enumerate(getWorkerPool().imap_unordered(bakeFrame, tasks)):
+            wm.progress_update(i+1)
+        wm.progress_end()
+
+        bakeImage = bpy.data.images.get(node.name+"_bake")
+        if bakeImage is not None:
+            bpy.data.images.remove(bakeImage)
+        bakeImage = bpy.data.images.load(tasks[0][0])
+        bakeImage.name = node.name+"_bake"
+        bakeImage.source = 'SEQUENCE'
+        bakeImage.alpha_mode = 'CHANNEL_PACKED'
+        # The 16 bit PNG is loaded as float, the same color space as the node image keeps the look
+        bakeImage.colorspace_settings.name = LINEAR_COLORSPACE
+        node.bakeStart = scene.frame_start
+        node.bakeEnd = scene.frame_end
+        node.useBake = True
+        node.update_bake(context)
+        return {'FINISHED'}
+
+class LightningBoltAdd(bpy.types.Operator):
+    """ Adds a bolt to the node, it starts as a copy of the main bolt with the next seed.
+    """
+    bl_idname = "node.lightning_bolt_add"
+    bl_label = "Add lightning bolt"
+    nodeName: bpy.props.StringProperty()
+
+    def execute(self, context):
+        node = context.space_data.edit_tree.nodes[self.nodeName]
+        coords = node.getCoords(context.scene.frame_current)
+        bolt = node.bolts.add()
+        bolt.startX, bolt.startY, bolt.endX, bolt.endY = coords
+        bolt.seed = node.seed+len(node.bolts)
+        return {'FINISHED'}
+
+class LightningBoltRemove(bpy.types.Operator):
+    bl_idname = "node.lightning_bolt_remove"
+    bl_label = "Remove lightning bolt"
+    nodeName: bpy.props.StringProperty()
+    index: bpy.props.IntProperty()
+
+    def execute(self, context):
+        node = context.space_data.edit_tree.nodes[self.nodeName]
+        node.bolts.remove(self.index)
+        node.update_effect(context)
+        return {'FINISHED'}
+
+def applyResults():
+    """ Draws the masks finished by the background worker into the node images, runs in the main thread as a timer.
+    """
+    global applyRegistered
+    for name, (tree, masks, frame, factor, timer) in backgroundWorker.popResults():
+        try:
+            node = tree.nodes.get(name)
+        except ReferenceError:
+            continue
+        if node is None or node.useBake:
+            continue
+        node.applyMasks(masks, bpy.data.images[node.name], frame, factor, timer)
+    if backgroundWorker.isBusy():
+        return APPLY_INTERVAL
+    applyRegistered = False
+    return None
+
+@bpy.app.handlers.persistent
+def renderFullResolution(scene, *args):
+    """ Final renders always use the full resolution bolt of the rendered frame.
+    """
+    if scene.node_tree is None:
+        return
+    for node in scene.node_tree.nodes:
+        if node.bl_idname == LightningGen.__name__ and not node.useBake:
+            node.drawFrame(scene.frame_current, False)
+
+@bpy.app.handlers.persistent
+def resetNodeStates(*args):
+    """ The states belong to the nodes of the previous file, the pixels of the generated images are not saved so the nodes draw again.
+        The timers of applyResults and of the refines are dropped by the load, the new states and the flag let them be registered again.
+    """
+    global applyRegistered
+    nodeStates.clear()
+    applyRegistered = bpy.app.timers.is_registered(applyResults)
+
 def menu_func_input(self, context):
     self.layout.operator(
         "node.add_node",
@@ -372,13 +692,32 @@ def menu_func_input(self, context):
     ).type = "LightningGen"
 
 def register():
+    bpy.utils.register_class(LightningBolt)
     bpy.utils.register_class(LightningGen)
+    bpy.utils.register_class(LightningBake)
+    bpy.utils.register_class(LightningBoltAdd)
+    bpy.utils.register_class(LightningBoltRemove)
+    bpy.app.handlers.render_pre.append(renderFullResolution)
+    bpy.app.handlers.load_post.append(resetNodeStates)
     bpy.types.NODE_MT_category_compositor_input.append(menu_func_input)
 
 
 def unregister():
+    global applyRegistered
+    closeWorkerPool()
+    if bpy.app.timers.is_registered(applyResults):
+        bpy.app.timers.unregister(applyResults)
+    applyRegistered = False
+    if renderFullResolution in bpy.app.handlers.render_pre:
+        bpy.app.handlers.render_pre.remove(renderFullResolution)
+    if resetNodeStates in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(resetNodeStates)
     bpy.types.NODE_MT_category_compositor_input.remove(menu_func_input)
+    bpy.utils.unregister_class(LightningBoltRemove)
+    bpy.utils.unregister_class(LightningBoltAdd)
+    bpy.utils.unregister_class(LightningBake)
     bpy.utils.unregister_class(LightningGen)
+    bpy.utils.unregister_class(LightningBolt)
 
 try:
     unregister()
@@ -0,0 +1,110 @@
+""" Measures the lightning generation and rasterization outside of Blender.
+    usage: python lightningBenchmark.py [--full] [--tiled] [--analytic] [--json results.json] [--baseline results.json]
+    By default each parameter is varied separately around the default node settings, --full measures all combinations.
+    With --baseline the script fails when a case is slower or uses more memory than the baseline times the tolerance.
+"""
+import argparse
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+import numpy as np
+import lightningCore
+
+COMPLEXITIES = [5, 8, 11, 14, 17]
+THICKNESSES = [0, 3, 25, 50, 100]
+FORKINGS = [0.0, 0.5, 1.0]
+RESOLUTIONS = {"720p": (1280, 720), "1080p": (1920, 1080), "4K": (3840, 2160), "8K": (7680, 4320)}
+DEFAULT = {"complexity": 8, "thickness": 3, "forking": 0.5, "resolution": "1080p"}
+
+def getCases(full):
+    if full:
+        for complexity, thickness, forking, resolution in itertools.product(COMPLEXITIES, THICKNESSES, FORKINGS, RESOLUTIONS):
+            yield {"complexity": complexity, "thickness": thickness, "forking": forking, "resolution": resolution}
+        return
+    values = {"complexity": COMPLEXITIES, "thickness": THICKNESSES, "forking": FORKINGS, "resolution": list(RESOLUTIONS)}
+    cases = []
+    for name, options in values.items():
+        for value in options:
+            case = dict(DEFAULT, **{name: value})
+            if case not in cases:
+                cases.append(case)
+    yield from cases
+
+def caseName(case):
+    return "c{complexity}_t{thickness}_f{forking}_{resolution}".format(**case)
+
+def runCase(case, tiled, analytic):
+    """ Generates and rasterizes the bolt the same way as a node with default settings placed in the middle third of the frame.
+    """
+    w, h = RESOLUTIONS[case["resolution"]]
+    coord = [w//3, h//2, w-w//3, h//2]
+    rasterize = lightningCore.rasterizeBoltTiled if tiled else lightningCore.rasterizeBolt
+    start = time.perf_counter()
+    bolt = lightningCore.generateBolt(np.array(coord[:2]), np.array(coord[2:]), 0, case["complexity"], 0.5, case["forking"], 0.5)
+    generated = time.perf_counter()
+    if analytic:
+        lightningCore.rasterizeGlow(bolt, w, h, case["thickness"], 0.5, 1.0, coord, 5, 60)
+    else:
+        rasterize(bolt, w, h, case["thickness"], 0.5, 1.0, coord)
+    end = time.perf_counter()
+    return generated-start, end-generated
+
+def measure(case, tiled, analytic, repeat):
+    times = [runCase(case, tiled, analytic) for i in range(repeat)]
+    generation = min(t[0] for t in times)
+    rasterization = min(t[1] for t in times)
+    # Memory is measured in a separate run since the tracing slows down the computation
+    tracemalloc.start()
+    runCase(case, tiled, analytic)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"generation": generation, "rasterization": rasterization, "total": generation+rasterization, "peakMemory": peak}
+
+def compare(results, baseline, tolerance, slack):
+    """ Returns the cases exceeding the baseline times the tolerance, slack is added to the allowed time so that very fast cases do not fail on noise.
+    """
+    failures = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, extra in (("total", slack), ("peakMemory", 0)):
+            if result[metric] > baseline[name][metric]*tolerance+extra:
+                failures.append(name+" "+metric+": "+str(round(result[metric], 4))+" > "+str(round(baseline[name][metric], 4))+" * "+str(tolerance))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="Lightning generator benchmark")
+    parser.add_argument("--full", action="store_true", help="measure all combinations of the parameters")
+    parser.add_argument("--tiled", action="store_true", help="use the tile-parallel rasterizer")
+    parser.add_argument("--analytic", action="store_true", help="compute the analytic core and glow with the default blur sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the fastest one is reported")
+    parser.add_argument("--json", help="store the results in this file")
+    parser.add_argument("--baseline", help="compare the results with this file")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed ratio to the baseline")
+    parser.add_argument("--slack", type=float, default=0.01, help="seconds always allowed above the baseline")
+    args = parser.parse_args()
+
+    results = {}
+    print("{:<28}{:>12}{:>12}{:>12}{:>12}".format("case", "generate s", "raster s", "total s", "peak MB"))
+    for case in getCases(args.full):
+        name = caseName(case)
+        result = measure(case, args.tiled, args.analytic, args.repeat)
+        results[name] = result
+        print("{:<28}{:>12.4f}{:>12.4f}{:>12.4f}{:>12.1f}".format(name, result["generation"], result["rasterization"], result["total"], result["peakMemory"]/(1 << 20)))
+    lightningCore.closeWorkerPool()
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=1)
+    if args.baseline:
+        with open(args.baseline) as file:
+            failures = compare(results, json.load(file), args.tolerance, args.slack)
+        for failure in failures:
+            print("REGRESSION "+failure)
+        if failures:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,583 @@
+""" Lightning bolt generation and rasterization without any dependency on Blender.
+    Used by the LightningGen compositor node in lightning.py and by lightningBenchmark.py.
+"""
+import numpy as np
+import math
+import time
+import threading
+import traceback
+import struct
+import zlib
+from multiprocessing import Pool, shared_memory
+from collections import OrderedDict
+
+
+class Bolt:
+    """ Struct-of-arrays bolt geometry: vertex positions, segments as pairs of vertex indices and the fork level of each segment.
+    """
+    def __init__(self, vertices, segments, levels):
+        self.vertices = vertices
+        self.segments = segments
+        self.levels = levels
+
+    def getMaxLevel(self):
+        if len(self.levels) == 0:
+            return 0
+        return int(self.levels.max())
+
+    def getCoords(self):
+        return self.vertices[self.segments[:, 0]], self.vertices[self.segments[:, 1]]
+
+    def getSize(self):
+        return self.vertices.nbytes + self.segments.nbytes + self.levels.nbytes
+
+    def scaled(self, scale):
+        return Bolt(self.vertices*scale, self.segments, self.levels)
+
+def generateBolt(p0, p1, seed, complexity, stability, forking, maxForkAngle, token=None):
+    """ Subdivides the p0-p1 segment complexity times, each level is computed for all segments at once.
+        The random values do not depend on the endpoints so moving them only transforms the same bolt.
+        The optional cancel token is checked before each level.
+    """
+    rng = np.random.default_rng(seed)
+    vertices = np.array([p0, p1], dtype=np.float64)
+    segments = np.array([[0, 1]], dtype=np.int64)
+    levels = np.zeros(1, dtype=np.int32)
+    randRange = (1.0-stability)*np.linalg.norm(vertices[1]-vertices[0])
+    for i in range(complexity):
+        if token is not None:
+            token.check()
+        count = len(segments)
+        a = vertices[segments[:, 0]]
+        b = vertices[segments[:, 1]]
+        vector = b-a
+        normal = np.stack([vector[:, 1], -vector[:, 0]], axis=1)
+        normalLength = np.linalg.norm(normal, axis=1, keepdims=True)
+        normal = np.divide(normal, normalLength, out=np.zeros_like(normal), where=normalLength > 0)
+        midpoints = (a+b)/2 + normal*(rng.uniform(-1.0, 1.0, count)*randRange)[:, None]
+        midpointIDs = np.arange(len(vertices), len(vertices)+count)
+
+        # The random values are drawn for all segments even on levels without forking to keep the sequence stable
+        forkChance = rng.uniform(0.0, 1.0, count)
+        angles = rng.uniform(0.1, 1.55*maxForkAngle, count)
+        angles = np.where(rng.uniform(0.0, 1.0, count) > 0.5, -angles, angles)
+        forks = np.flatnonzero(forkChance < forking) if i < int(complexity/2) else np.empty(0, dtype=np.int64)
+        forkDirection = midpoints[forks]-a[forks]
+        cosVal = np.cos(angles[forks])
+        sinVal = np.sin(angles[forks])
+        forkEnds = midpoints[forks] + np.stack([cosVal*forkDirection[:, 0] - sinVal*forkDirection[:, 1],
+                                                sinVal*forkDirection[:, 0] + cosVal*forkDirection[:, 1]], axis=1)
+        forkEndIDs = np.arange(len(vertices)+count, len(vertices)+count+len(forks))
+
+        vertices = np.concatenate([vertices, midpoints, forkEnds])
+        segments = np.concatenate([np.stack([segments[:, 0], midpointIDs], axis=1),
+                                   np.stack([midpointIDs, segments[:, 1]], axis=1),
+                                   np.stack([midpointIDs[forks], forkEndIDs], axis=1)])
+        levels = np.concatenate([levels, levels, levels[forks]+1])
+        randRange /= 2
+    return Bolt(vertices, segments, levels)
+
+# Shifts the disc coordinates to positive numbers so that they can be packed in one integer
+DISC_OFFSET = 1 << 20
+# Falloffs are evaluated in a resolution where their sigma is at least this many pixels so that they can be bilinearly enlarged
+FALLOFF_SIGMA = 3.0
+# Size of the tiles rasterized in parallel, bolts with a smaller bounding box are rasterized directly
+TILE_SIZE = 256
+# Process pool shared by the tile rasterization and baking
+workerPool = None
+
+def boltRadii(bolt, thickness, falloff, perspectiveScale, coord):
+    """ Returns the radius at the start and at the end of each segment.
+        The width decreases with the fork level and the perspective scale widens the bolt towards the end point.
+    """
+    maxLevel = bolt.getMaxLevel()
+    if maxLevel == 0:
+        widths = np.full(len(bolt.levels), float(thickness))
+    else:
+        widths = np.floor(np.clip(thickness*(1.0-(bolt.levels/(falloff*maxLevel))), 0, thickness))
+    if perspectiveScale == 1.0:
+        return widths, widths
+    starts, ends = bolt.getCoords()
+    origin = np.array([coord[0], coord[1]], dtype=np.float64)
+    maxDist = max(np.linalg.norm(np.array([coord[2], coord[3]])-origin), 1.0)
+    def scaleRadius(points):
+        return np.linalg.norm(points-origin, axis=1)/maxDist*perspectiveScale*widths+widths
+    return scaleRadius(starts), scaleRadius(ends)
+
+def boltDiscs(starts, ends, startRadii, endRadii):
+    """ Covers each segment capsule by discs sampled with pixel spacing along the segment, the radius is interpolated between the segment ends.
+        The discs are snapped to the pixel grid and duplicates are removed, complex bolts consist mostly of sub-pixel segments
+        so the number of discs stays proportional to the length of the bolt in pixels.
+    """
+    lengths = np.linalg.norm(ends-starts, axis=1)
+    counts = np.where(lengths < 1.0, 1, np.ceil(lengths).astype(np.int64)+1)
+    segmentIDs = np.repeat(np.arange(len(counts)), counts)
+    sampleIDs = np.arange(len(segmentIDs))-np.repeat(np.cumsum(counts)-counts, counts)
+    t = np.where(counts[segmentIDs] == 1, 0.5, sampleIDs/np.maximum(counts[segmentIDs]-1, 1))
+    centers = np.round(starts[segmentIDs]+t[:, None]*(ends-starts)[segmentIDs]).astype(np.int64)
+    radii = startRadii[segmentIDs]+t*(endRadii-startRadii)[segmentIDs]
+    return uniqueDiscs(centers, radii)
+
+def uniqueDiscs(centers, radii):
+    """ Removes the duplicate discs, the integer centers are kept and the radii are rounded to halves of a pixel.
+    """
+    # Packed into a single key which is much faster to sort than unique rows
+    keys = np.unique(((centers[:, 0]+DISC_OFFSET) << 42) | ((centers[:, 1]+DISC_OFFSET) << 21) | np.round(radii*2).astype(np.int64))
+    mask = (1 << 21)-1
+    centers = np.column_stack([(keys >> 42)-DISC_OFFSET, ((keys >> 21) & mask)-DISC_OFFSET])
+    return centers, (keys & mask)/2.0
+
+def discsRect(centers, radii, w, h):
+    """ Returns the bounding box (x0, y0, x1, y1) of the discs clipped to the image, None if they are outside.
+    """
+    if len(radii) == 0:
+        return None
+    extent = np.ceil(radii).astype(np.int64)
+    x0 = max(int((centers[:, 0]-extent).min()), 0)
+    y0 = max(int((centers[:, 1]-extent).min()), 0)
+    x1 = min(int((centers[:, 0]+extent).max())+1, w)
+    y1 = min(int((centers[:, 1]+extent).max())+1, h)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return x0, y0, x1, y1
+
+def discsCoverage(centers, radii, w, h, offset=(0, 0)):
+    """ Returns the h x w boolean image of the pixels whose distance from a disc center is at most its radius.
+        Each disc is written as one horizontal span per row into a difference buffer that is accumulated at the end,
+        so the cost grows with the disc radius and not its area. The offset is the position of the image.
+    """
+    centers = centers-np.asarray(offset, dtype=np.int64)
+    extent = np.ceil(radii).astype(np.int64)
+    visible = ((centers+extent[:, None] >= 0) & (centers-extent[:, None] < [w, h])).all(axis=1) & (radii >= 0)
+    centers = centers[visible]
+    radii = radii[visible]
+    extent = extent[visible]
+    rows = 2*extent+1
+    discIDs = np.repeat(np.arange(len(rows)), rows)
+    dy = np.arange(len(discIDs))-np.repeat(np.cumsum(rows)-rows, rows)-extent[discIDs]
+    halfWidthSq = radii[discIDs]**2-dy**2
+    y = centers[discIDs, 1]+dy
+    keep = (halfWidthSq >= 0) & (y >= 0) & (y < h)
+    discIDs = discIDs[keep]
+    y = y[keep]
+    halfWidth = np.floor(np.sqrt(halfWidthSq[keep])).astype(np.int64)
+    x0 = np.maximum(centers[discIDs, 0]-halfWidth, 0)
+    x1 = np.minimum(centers[discIDs, 0]+halfWidth+1, w)
+    keep = x0 < x1
+    y = y[keep]
+    size = h*(w+1)
+    spans = np.bincount(y*(w+1)+x0[keep], minlength=size)-np.bincount(y*(w+1)+x1[keep], minlength=size)
+    return np.cumsum(spans.reshape(h, w+1)[:, :w], axis=1) > 0
+
+def rasterizeDiscs(centers, radii, out, offset=(0, 0)):
+    """ Sets out to 1.0 in all pixels covered by the discs, the offset is the position of out in the image.
+    """
+    h, w = out.shape
+    out[discsCoverage(centers, radii, w, h, offset)] = 1.0
+
+def enlargeBilinear(image, factor, w, h):
+    """ Bilinearly interpolates the w x h image from the image computed at 1/factor of the resolution.
+    """
+    def coordinates(size, lowSize):
+        position = np.arange(size)/factor
+        low = position.astype(np.int64)
+        return low, np.minimum(low+1, lowSize-1), (position-low).astype(np.float32)
+    x0, x1, fx = coordinates(w, image.shape[1])
+    y0, y1, fy = coordinates(h, image.shape[0])
+    top = image[y0][:, x0]*(1.0-fx) + image[y0][:, x1]*fx
+    bottom = image[y1][:, x0]*(1.0-fx) + image[y1][:, x1]*fx
+    return top*(1.0-fy)[:, None] + bottom*fy[:, None]
+
+def coreProfile(distance, sigma):
+    """ Intensity of an edge blurred by a gaussian at the distance from the edge, negative inside.
+    """
+    if sigma == 0:
+        return 1.0 if distance <= 0 else 0.0
+    return 0.5*math.erfc(distance/(sigma*math.sqrt(2)))
+
+def glowProfile(distance, sigma):
+    """ Gaussian falloff of the light outside of the bolt.
+    """
+    if distance <= 0:
+        return 1.0
+    if sigma == 0:
+        return 0.0
+    return math.exp(-distance*distance/(2*sigma*sigma))
+
+def rasterizeFalloff(centers, radii, rect, sigma, profile):
+    """ Returns the float32 image of the rect with profile(d, sigma) in each pixel, d is the distance to the surface of the nearest disc.
+        The distance is quantized to pixel levels and the image is the sum of the masks of the discs grown by each level weighted by the profile difference.
+        Wide falloffs are computed in a lower resolution and bilinearly enlarged.
+    """
+    x0, y0, x1, y1 = rect
+    factor = max(1, int(sigma/FALLOFF_SIGMA))
+    w = -(-(x1-x0)//factor)
+    h = -(-(y1-y0)//factor)
+    centers, radii = uniqueDiscs(np.round((centers-[x0, y0])/factor).astype(np.int64), radii/factor)
+    reach = math.ceil(3*sigma/factor)
+    levels = range(-reach, reach+1)
+    values = [profile(level*factor, sigma) for level in levels]+[0.0]
+    image = np.zeros((h, w), dtype=np.float32)
+    for i, level in enumerate(levels):
+        weight = values[i]-values[i+1]
+        if weight != 0:
+            image += weight*discsCoverage(centers, radii+level, w, h)
+    if factor == 1:
+        return image
+    return enlargeBilinear(image, factor, x1-x0, y1-y0)
+
+def rasterizeBolt(bolt, w, h, thickness, falloff, perspectiveScale, coord):
+    """ Returns the bounding box (x0, y0, x1, y1) of the bolt in the w x h image and the float32 mask of the box.
+        The box is None if the bolt is outside of the image.
+    """
+    starts, ends = bolt.getCoords()
+    centers, radii = boltDiscs(starts, ends, *boltRadii(bolt, thickness, falloff, perspectiveScale, coord))
+    rect = discsRect(centers, radii, w, h)
+    if rect is None:
+        return None, np.zeros((0, 0), dtype=np.float32)
+    x0, y0, x1, y1 = rect
+    mask = np.zeros((y1-y0, x1-x0), dtype=np.float32)
+    rasterizeDiscs(centers, radii, mask, (x0, y0))
+    return rect, mask
+
+def rasterizeGlow(bolt, w, h, thickness, falloff, perspectiveScale, coord, coreBlur, glow):
+    """ Replaces blurring of the bolt mask, returns the bounding box of the lit area and a float32 array with the core (channel 0)
+        and glow (channel 1) intensities computed from the distance to the bolt. Half of the blur sizes is used as the gaussian sigma.
+        The glow is dimmed the same way as a blurred line of the bolt thickness.
+    """
+    starts, ends = bolt.getCoords()
+    centers, radii = boltDiscs(starts, ends, *boltRadii(bolt, thickness, falloff, perspectiveScale, coord))
+    coreSigma = coreBlur/2
+    glowSigma = glow/2
+    rect = discsRect(centers, radii+3*max(coreSigma, glowSigma), w, h)
+    if rect is None:
+        return None, np.zeros((0, 0, 2), dtype=np.float32)
+    x0, y0, x1, y1 = rect
+    region = np.empty((y1-y0, x1-x0, 2), dtype=np.float32)
+    region[:, :, 0] = rasterizeFalloff(centers, radii, rect, coreSigma, coreProfile)
+    peak = 1.0
+    if glowSigma > 0:
+        peak = math.erf((thickness+0.5)/(glowSigma*math.sqrt(2)))
+    region[:, :, 1] = rasterizeFalloff(centers, radii, rect, glowSigma, lambda distance, sigma: peak*glowProfile(distance, sigma))
+    return rect, region
+
+def upscaleMask(mask, factor, w, h):
+    """ Enlarges the mask rasterized at 1/factor of the w x h image by repeating its pixels.
+    """
+    rect, region = mask
+    if rect is None:
+        return mask
+    x0, y0, x1, y1 = [c*factor for c in rect]
+    region = np.repeat(np.repeat(region, factor, axis=0), factor, axis=1)
+    x1 = min(x1, w)
+    y1 = min(y1, h)
+    return (x0, y0, x1, y1), region[:y1-y0, :x1-x0]
+
+def getWorkerPool():
+    global workerPool
+    if workerPool is None:
+        workerPool = Pool()
+    return workerPool
+
+def closeWorkerPool():
+    global workerPool
+    if workerPool is not None:
+        workerPool.terminate()
+        workerPool = None
+
+def rasterizeTile(task):
+    name, shape, offset, x0, y0, x1, y1, centers, radii = task
+    memory = shared_memory.SharedMemory(name=name)
+    buffer = np.ndarray(shape, dtype=np.float32, buffer=memory.buf)
+    rasterizeDiscs(centers, radii, buffer[y0-offset[1]:y1-offset[1], x0-offset[0]:x1-offset[0]], (x0, y0))
+    del buffer
+    memory.close()
+
+def binDiscs(centers, radii, x0, y0, tilesX, tilesY):
+    """ Assigns the discs to all tiles they overlap, returns the tile index of each assignment and the disc indices sorted by the tiles.
+    """
+    extent = np.ceil(radii).astype(np.int64)
+    low = np.clip((centers-extent[:, None]-[x0, y0])//TILE_SIZE, 0, [tilesX-1, tilesY-1])
+    high = np.clip((centers+extent[:, None]-[x0, y0])//TILE_SIZE, 0, [tilesX-1, tilesY-1])
+    spans = high-low+1
+    counts = spans[:, 0]*spans[:, 1]
+    discIDs = np.repeat(np.arange(len(counts)), counts)
+    local = np.arange(len(discIDs))-np.repeat(np.cumsum(counts)-counts, counts)
+    tiles = (low[discIDs, 1]+local//spans[discIDs, 0])*tilesX + low[discIDs, 0]+local%spans[discIDs, 0]
+    order = np.argsort(tiles, kind="stable")
+    return tiles[order], discIDs[order]
+
+def rasterizeBoltTiled(bolt, w, h, thickness, falloff, perspectiveScale, coord):
+    """ Same as rasterizeBolt but the bounding box of the bolt is split into tiles rasterized by a process pool into a shared buffer.
+    """
+    starts, ends = bolt.getCoords()
+    centers, radii = boltDiscs(starts, ends, *boltRadii(bolt, thickness, falloff, perspectiveScale, coord))
+    rect = discsRect(centers, radii, w, h)
+    if rect is None:
+        return None, np.zeros((0, 0), dtype=np.float32)
+    x0, y0, x1, y1 = rect
+    shape = (y1-y0, x1-x0)
+    tilesX = -(-shape[1]//TILE_SIZE)
+    tilesY = -(-shape[0]//TILE_SIZE)
+    if tilesX*tilesY == 1:
+        mask = np.zeros(shape, dtype=np.float32)
+        rasterizeDiscs(centers, radii, mask, (x0, y0))
+        return rect, mask
+
+    memory = shared_memory.SharedMemory(create=True, size=shape[0]*shape[1]*4)
+    try:
+        tiles, discIDs = binDiscs(centers, radii, x0, y0, tilesX, tilesY)
+        bounds = np.searchsorted(tiles, np.arange(tilesX*tilesY+1))
+        tasks = []
+        for tile in range(tilesX*tilesY):
+            if bounds[tile] == bounds[tile+1]:
+                continue
+            ids = discIDs[bounds[tile]:bounds[tile+1]]
+            tileX = x0+(tile%tilesX)*TILE_SIZE
+            tileY = y0+(tile//tilesX)*TILE_SIZE
+            tasks.append((memory.name, shape, (x0, y0), tileX, tileY, min(tileX+TILE_SIZE, x1), min(tileY+TILE_SIZE, y1), centers[ids], radii[ids]))
+        getWorkerPool().map(rasterizeTile, tasks)
+        mask = np.ndarray(shape, dtype=np.float32, buffer=memory.buf).copy()
+    finally:
+        memory.close()
+        memory.unlink()
+    return rect, mask
+
+class LRUCache:
+    """ Keeps the most recently used values until their total size exceeds maxBytes, can be shared between threads.
+    """
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.maxBytes:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.maxBytes:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+def writePNG(path, pixels):
+    """ Writes the h x w x 4 uint8 or uint16 RGBA pixels as a 8 or 16 bit PNG file, the rows are ordered from the bottom as in Blender.
+    """
+    h, w, _ = pixels.shape
+    depth = 16 if pixels.dtype == np.uint16 else 8
+    # PNG stores the 16 bit samples in the big-endian order
+    rows = pixels[::-1].astype(">u2" if depth == 16 else np.uint8).reshape(h, -1).view(np.uint8)
+    raw = np.zeros((h, 1+rows.shape[1]), dtype=np.uint8)
+    raw[:, 1:] = rows
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag+data) & 0xffffffff)
+    with open(path, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(chunk(b"IHDR", struct.pack(">IIBBBBB", w, h, depth, 6, 0, 0, 0)))
+        file.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 1)))
+        file.write(chunk(b"IEND", b""))
+
+def computeMask(cache, coord, w, h, settings, factor=1, tiled=False, timer=None, token=None):
+    """ Returns the mask of the bolt (see rasterizeBolt and rasterizeGlow) rasterized at 1/factor of the w x h resolution and enlarged back.
+        The geometry and the mask are taken from the cache if it is given and contains them.
+        The settings is a dictionary with the node properties affecting the bolt, see LightningGen.getSettings.
+    """
+    # The geometry depends only on these parameters, the mask also on the appearance of the bolt
+    geometryKey = (tuple(coord), settings["seed"], settings["complexity"], settings["stability"], settings["forking"], settings["maxForkAngle"])
+    bolt = cache.get(geometryKey) if cache is not None else None
+    if bolt is None:
+        bolt = generateBolt(np.array(coord[:2]), np.array(coord[2:]), settings["seed"], settings["complexity"], settings["stability"],
+                            settings["forking"], settings["maxForkAngle"], token)
+        if cache is not None:
+            cache.put(geometryKey, bolt, bolt.getSize())
+    if timer is not None:
+        timer.lap("generation")
+    if token is not None:
+        token.check()
+    maskKey = geometryKey + (settings["thickness"], settings["falloff"], settings["perspectiveScale"], w, h, factor)
+    analytic = settings["glowMode"] == 'ANALYTIC'
+    if analytic:
+        maskKey += (settings["coreBlur"], settings["glow"])
+    mask = cache.get(maskKey) if cache is not None else None
+    if mask is None:
+        scale = 1.0/factor
+        scaledBolt = bolt if factor == 1 else bolt.scaled(scale)
+        scaledCoord = [c*scale for c in coord]
+        lowW = -(-w//factor)
+        lowH = -(-h//factor)
+        if analytic:
+            mask = rasterizeGlow(scaledBolt, lowW, lowH, settings["thickness"]*scale, settings["falloff"], settings["perspectiveScale"],
+                                 scaledCoord, settings["coreBlur"]*scale, settings["glow"]*scale)
+        else:
+            rasterize = rasterizeBoltTiled if tiled else rasterizeBolt
+            mask = rasterize(scaledBolt, lowW, lowH, settings["thickness"]*scale, settings["falloff"], settings["perspectiveScale"], scaledCoord)
+        if factor != 1:
+            mask = upscaleMask(mask, factor, w, h)
+        if cache is not None:
+            cache.put(maskKey, mask, mask[1].nbytes)
+    if timer is not None:
+        timer.lap("rasterization")
+    return mask
+
+def computeMasks(cache, bolts, w, h, settings, factor=1, tiled=False, timer=None, token=None):
+    """ Returns the list of masks of the bolts given as (coord, seed) pairs, see computeMask.
+        Each bolt is cached separately so only the changed bolts are generated again.
+    """
+    masks = []
+    for coord, seed in bolts:
+        if abs(coord[0]-coord[2]) + abs(coord[1]-coord[3]) < 0.0001:
+            continue
+        boltSettings = dict(settings, seed=seed)
+        masks.append(computeMask(cache, coord, w, h, boltSettings, factor, tiled, timer, token))
+    return masks
+
+def bakeFrame(task):
+    """ Generates and rasterizes the bolts of one frame and stores them as a 16 bit PNG, runs in the worker processes.
+        Overlapping bolts are combined by the maximum. 8 bits would band the smooth analytic glow.
+    """
+    path, w, h, bolts, settings = task
+    pixels = np.zeros((h, w, 4), dtype=np.uint16)
+    analytic = settings["glowMode"] == 'ANALYTIC'
+    # The analytic glow is packed in the alpha channel
+    pixels[:, :, 3] = 0 if analytic else 65535
+    for rect, region in computeMasks(None, bolts, w, h, settings):
+        if rect is None:
+            continue
+        x0, y0, x1, y1 = rect
+        region = np.round(region*65535).astype(np.uint16)
+        if analytic:
+            np.maximum(pixels[y0:y1, x0:x1, :3], region[:, :, 0, None], out=pixels[y0:y1, x0:x1, :3])
+            np.maximum(pixels[y0:y1, x0:x1, 3], region[:, :, 1], out=pixels[y0:y1, x0:x1, 3])
+        else:
+            np.maximum(pixels[y0:y1, x0:x1, :3], region[:, :, None], out=pixels[y0:y1, x0:x1, :3])
+    writePNG(path, pixels)
+    return path
+
+class Cancelled(Exception):
+    pass
+
+class CancelToken:
+    def __init__(self):
+        self.cancelled = False
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+class CoalescingWorker:
+    """ Runs jobs on a background thread, only the latest job of each key matters.
+        Submitting a job drops the pending one with the same key and cancels the running one.
+        The job is called with a cancel token and its result is kept until taken by popResults, e.g. from the main thread of Blender.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = OrderedDict()
+        self.running = {}
+        self.results = OrderedDict()
+        self.thread = None
+
+    def submit(self, key, job):
+        with self.condition:
+            if key in self.running:
+                self.running[key].cancelled = True
+            self.pending.pop(key, None)
+            self.pending[key] = job
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                key, job = self.pending.popitem(last=False)
+                token = CancelToken()
+                self.running[key] = token
+            try:
+                result = job(token)
+            except Cancelled:
+                result = None
+            except Exception:
+                traceback.print_exc()
+                result = None
+            with self.condition:
+                if self.running.get(key) is token:
+                    del self.running[key]
+                if result is not None and not token.cancelled:
+                    self.results.pop(key, None)
+                    self.results[key] = result
+
+    def popResults(self):
+        with self.condition:
+            results = list(self.results.items())
+            self.results.clear()
+        return results
+
+    def isBusy(self):
+        with self.condition:
+            return bool(self.pending or self.running or self.results)
+
+class StageTimer:
+    """ Measures the durations of the consecutive stages of one update in milliseconds, skipped stages stay zero.
+    """
+    STAGES = ("markers", "generation", "rasterization", "upload", "update")
+
+    def __init__(self):
+        self.timings = dict.fromkeys(self.STAGES, 0.0)
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] += (now-self.last)*1000
+        self.last = now
+
+    def skip(self):
+        """ Starts the next stage now, the time since the last lap (e.g. waiting in a queue) is not counted.
+        """
+        self.last = time.perf_counter()
+
+    def getTotal(self):
+        return sum(self.timings.values())
+
+class Trajectory:
+    """ Pixel positions of a motion track for every frame of the range, frames without a marker are linearly interpolated.
+        The markers are kept to detect changes of the track.
+    """
+    def __init__(self, frames, coords, size, frameStart, frameEnd):
+        self.frames = frames
+        self.coords = coords
+        self.size = size
+        self.frameStart = frameStart
+        self.frameEnd = frameEnd
+        self.positions = self.interpolate(np.arange(frameStart, frameEnd+1))
+
+    def interpolate(self, frames):
+        return np.column_stack([np.interp(frames, self.frames, self.coords[:, 0]*self.size[0]),
+                                np.interp(frames, self.frames, self.coords[:, 1]*self.size[1])])
+
+    def matches(self, frames, coords, size, frameStart, frameEnd):
+        return (self.size == size and self.frameStart == frameStart and self.frameEnd == frameEnd and
+                np.array_equal(self.frames, frames) and np.array_equal(self.coords, coords))
+
+    def getPosition(self, frame):
+        if self.frameStart <= frame <= self.frameEnd:
+            return self.positions[frame-self.frameStart]
+        return self.interpolate([frame])[0]